@@ -8,11 +8,23 @@ import theano.tensor as T
 from theano import config
 from theano.tensor.shared_randomstreams import RandomStreams
 
+from layers.layers import shared_on_target
+
+def with_state_reset(step_fn):
+    """ Wrap the step function of a recurrent layer, step_fn(Wx, h_tm1, c_tm1, W_h), to take the reset mask of packed
+    sequences as a second sequence of the scan: the states are set to zero at the first step of each sequence.
+    """
+
+    def reset_step_fn(Wx, r_t, h_tm1, c_tm1, W_h):
+        return step_fn(Wx, (1 - r_t) * h_tm1, (1 - r_t) * c_tm1, W_h)
+
+    return reset_step_fn
+
 class VanillaRNN(object):
     """ This class implements a standard recurrent neural network: h_{t} = f(W^{hx}x_{t} + W^{hh}h_{t-1}+b_{h})
 
     """
-    def __init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training=False):
+    def __init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training=False, target=None, reset=None):
         """ This is to initialise a standard RNN hidden unit
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -21,7 +33,14 @@ class VanillaRNN(object):
         :param n_h: number of hidden units/blocks
         :param p: the probability of dropout
         :param training: a binary value to indicate training or testing (for dropout training)
+        :param target: name of the gpuarray context holding the parameters and computing the scan, None for the default device
+        :param reset: a vector with 1 at the first frame of each sequence packed in x, where the states are reset to zero, None for a single sequence
         """
+        if target is not None:
+            x = x.transfer(target)
+            if reset is not None:
+                reset = reset.transfer(target)
+
         self.input = x
 
         if p > 0.0:
@@ -41,29 +60,35 @@ class VanillaRNN(object):
         Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
 
         # Input gate weights
-        self.W_xi = theano.shared(value=Wx_value, name='W_xi')
-        self.W_hi = theano.shared(value=Wh_value, name='W_hi')
+        self.W_xi = shared_on_target(Wx_value, 'W_xi', target)
+        self.W_hi = shared_on_target(Wh_value, 'W_hi', target)
 
         # bias
-        self.b_i = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_i')
+        self.b_i = shared_on_target(np.zeros((n_h, ), dtype=config.floatX), 'b_i', target)
 
 
         # initial value of hidden and cell state
         if self.rnn_batch_training:
-            self.h0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'c0')
+            self.h0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'c0', target)
 
             self.h0 = T.repeat(self.h0, x.shape[1], 0)
             self.c0 = T.repeat(self.c0, x.shape[1], 0)
         else:
-            self.h0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'c0')
+            self.h0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'c0', target)
 
 
-        self.Wix = T.dot(self.input, self.W_xi)
+        self.Wix = T.dot(self.input, self.W_xi) + self.b_i
 
-        [self.h, self.c], _ = theano.scan(self.recurrent_as_activation_function, sequences = [self.Wix],
-                                                                      outputs_info = [self.h0, self.c0])
+        if reset is None:
+            step_fn, sequences = self.recurrent_as_activation_function, [self.Wix]
+        else:
+            step_fn, sequences = with_state_reset(self.recurrent_as_activation_function), [self.Wix, reset]
+
+        [self.h, self.c], _ = theano.scan(step_fn, sequences = sequences,
+                                                   outputs_info = [self.h0, self.c0],
+                                                   non_sequences = [self.W_hi])
 
         self.output = self.h
 
@@ -72,18 +97,19 @@ class VanillaRNN(object):
         self.L2_cost = (self.W_xi ** 2).sum() + (self.W_hi ** 2).sum()
 
 
-    def recurrent_as_activation_function(self, Wix, h_tm1, c_tm1):
+    def recurrent_as_activation_function(self, Wix, h_tm1, c_tm1, W_hi):
         """ Implement the recurrent unit as an activation function. This function is called by self.__init__().
 
-        :param Wix: it equals to W^{hx}x_{t}, as it does not relate with recurrent, pre-calculate the value for fast computation
+        :param Wix: it equals to W^{hx}x_{t}+b_{h}, as it does not relate with recurrent, pre-calculate the value for fast computation
         :type Wix: matrix
         :param h_tm1: contains the hidden activation from previous time step
         :type h_tm1: matrix, each row means a hidden activation vector of a time step
         :param c_tm1: this parameter is not used, just to keep the interface consistent with LSTM
+        :param W_hi: the recurrent weight matrix, passed by scan as a non-sequence
         :returns: h_t is the hidden activation of current time step
         """
 
-        h_t = T.tanh(Wix + T.dot(h_tm1, self.W_hi) + self.b_i)  #
+        h_t = T.tanh(Wix + T.dot(h_tm1, W_hi))  #
 
         c_t = h_t
 
@@ -95,7 +121,7 @@ class VanillaRNNDecoder(object):
         y_{t} = g(h_{t}W^{hy} + b_{y})
 
     """
-    def __init__(self, rng, x, n_in, n_h, n_out, p, training, rnn_batch_training=False):
+    def __init__(self, rng, x, n_in, n_h, n_out, p, training, rnn_batch_training=False, target=None):
         """ This is to initialise a standard RNN hidden unit
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -105,7 +131,11 @@ class VanillaRNNDecoder(object):
         :param n_out: dimension of output data
         :param p: the probability of dropout
         :param training: a binary value to indicate training or testing (for dropout training)
+        :param target: name of the gpuarray context holding the parameters and computing the scan, None for the default device
         """
+        if target is not None:
+            x = x.transfer(target)
+
         self.input = x
 
         if p > 0.0:
@@ -130,39 +160,40 @@ class VanillaRNNDecoder(object):
         Uy_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_out), size=(n_out, n_out)), dtype=config.floatX)
 
         # Input gate weights
-        self.W_xi = theano.shared(value=Wx_value, name='W_xi')
-        self.W_hi = theano.shared(value=Wh_value, name='W_hi')
-        self.W_yi = theano.shared(value=Wy_value, name='W_yi')
+        self.W_xi = shared_on_target(Wx_value, 'W_xi', target)
+        self.W_hi = shared_on_target(Wh_value, 'W_hi', target)
+        self.W_yi = shared_on_target(Wy_value, 'W_yi', target)
 
         # Output gate weights
-        self.U_xi = theano.shared(value=Ux_value, name='U_xi')
-        self.U_hi = theano.shared(value=Uh_value, name='U_hi')
-        self.U_yi = theano.shared(value=Uy_value, name='U_yi')
+        self.U_xi = shared_on_target(Ux_value, 'U_xi', target)
+        self.U_hi = shared_on_target(Uh_value, 'U_hi', target)
+        self.U_yi = shared_on_target(Uy_value, 'U_yi', target)
 
         # bias
-        self.b_i = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_i')
-        self.b   = theano.shared(value=np.zeros((n_out, ), dtype=config.floatX), name='b')
+        self.b_i = shared_on_target(np.zeros((n_h, ), dtype=config.floatX), 'b_i', target)
+        self.b   = shared_on_target(np.zeros((n_out, ), dtype=config.floatX), 'b', target)
 
 
         # initial value of hidden and cell state and output
         if self.rnn_batch_training:
-            self.h0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'c0')
-            self.y0 = theano.shared(value=np.zeros((1, n_out), dtype = config.floatX), name = 'y0')
+            self.h0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'c0', target)
+            self.y0 = shared_on_target(np.zeros((1, n_out), dtype = config.floatX), 'y0', target)
 
             self.h0 = T.repeat(self.h0, x.shape[1], 0)
             self.c0 = T.repeat(self.c0, x.shape[1], 0)
             self.y0 = T.repeat(self.c0, x.shape[1], 0)
         else:
-            self.h0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'c0')
-            self.y0 = theano.shared(value=np.zeros((n_out, ), dtype = config.floatX), name = 'y0')
+            self.h0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'c0', target)
+            self.y0 = shared_on_target(np.zeros((n_out, ), dtype = config.floatX), 'y0', target)
 
 
-        self.Wix = T.dot(self.input, self.W_xi)
+        self.Wix = T.dot(self.input, self.W_xi) + self.b_i
 
         [self.h, self.c, self.y], _ = theano.scan(self.recurrent_as_activation_function, sequences = [self.Wix],
-                                                                      outputs_info = [self.h0, self.c0, self.y0])
+                                                                      outputs_info = [self.h0, self.c0, self.y0],
+                                                                      non_sequences = [self.W_hi])
 
         self.output = self.y
 
@@ -171,18 +202,19 @@ class VanillaRNNDecoder(object):
         self.L2_cost = (self.W_xi ** 2).sum() + (self.W_hi ** 2).sum() + (self.W_yi ** 2).sum() + (self.U_hi ** 2).sum()
 
 
-    def recurrent_as_activation_function(self, Wix, h_tm1, c_tm1, y_tm1):
+    def recurrent_as_activation_function(self, Wix, h_tm1, c_tm1, y_tm1, W_hi):
         """ Implement the recurrent unit as an activation function. This function is called by self.__init__().
 
-        :param Wix: it equals to W^{hx}x_{t}, as it does not relate with recurrent, pre-calculate the value for fast computation
+        :param Wix: it equals to W^{hx}x_{t}+b_{h}, as it does not relate with recurrent, pre-calculate the value for fast computation
         :type Wix: matrix
         :param h_tm1: contains the hidden activation from previous time step
         :type h_tm1: matrix, each row means a hidden activation vector of a time step
         :param c_tm1: this parameter is not used, just to keep the interface consistent with LSTM
+        :param W_hi: the recurrent weight matrix, passed by scan as a non-sequence
         :returns: h_t is the hidden activation of current time step
         """
 
-        h_t = T.tanh(Wix + T.dot(h_tm1, self.W_hi) + T.dot(y_tm1, self.W_yi) + self.b_i)  #
+        h_t = T.tanh(Wix + T.dot(h_tm1, W_hi) + T.dot(y_tm1, self.W_yi))  #
 
         y_t = T.dot(h_t, self.U_hi) + self.b
 
@@ -195,9 +227,15 @@ class LstmBase(object):
     """ This class provides as a base for all long short-term memory (LSTM) related classes.
     Several variants of LSTM were investigated in (Wu & King, ICASSP 2016): Zhizheng Wu, Simon King, "Investigating gated recurrent neural networks for speech synthesis", ICASSP 2016
 
+    The input and recurrent weights of the gates used by a variant are concatenated into two matrices,
+    W_x and W_h, so that each time step computes a single matrix product for all the gates.
+    The order of the gates in the concatenation is given by the class attribute `gates`.
+
     """
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'ifoc'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise all the components in a LSTM block, including input gate, output gate, forget gate, peephole connections
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -208,11 +246,19 @@ class LstmBase(object):
         :type n_h: integer
         :param p: the probability of dropout
         :param training: a binary value to indicate training or testing (for dropout training)
+        :param target: name of the gpuarray context holding the parameters and computing the scan, None for the default device
+        :param reset: a vector with 1 at the first frame of each sequence packed in x, where the states are reset to zero, None for a single sequence
+        :param build_scan: False to create the parameters and the initial states only, for a block whose time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
         n_in = int(n_in)  # ensure sizes have integer type
         n_h = int(n_h)# ensure sizes have integer type
 
+        if target is not None:
+            x = x.transfer(target)
+            if reset is not None:
+                reset = reset.transfer(target)
+
         self.input = x
 
         if p > 0.0:
@@ -227,89 +273,82 @@ class LstmBase(object):
 
         self.rnn_batch_training = rnn_batch_training
 
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
-
-        # Input gate weights
-        self.W_xi = theano.shared(value=Wx_value, name='W_xi')
-        self.W_hi = theano.shared(value=Wh_value, name='W_hi')
-        self.w_ci = theano.shared(value=Wc_value, name='w_ci')
-
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
-
-        # Forget gate weights
-        self.W_xf = theano.shared(value=Wx_value, name='W_xf')
-        self.W_hf = theano.shared(value=Wh_value, name='W_hf')
-        self.w_cf = theano.shared(value=Wc_value, name='w_cf')
-
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
-
-        # Output gate weights
-        self.W_xo = theano.shared(value=Wx_value, name='W_xo')
-        self.W_ho = theano.shared(value=Wh_value, name='W_ho')
-        self.w_co = theano.shared(value=Wc_value, name='w_co')
-
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
-
-        # Cell weights
-        self.W_xc = theano.shared(value=Wx_value, name='W_xc')
-        self.W_hc = theano.shared(value=Wh_value, name='W_hc')
+        # random initialisation of input gate, forget gate, output gate and cell weights, in this order
+        Wx_values = {}
+        Wh_values = {}
+        Wc_values = {}
+        for gate in 'ifoc':
+            Wx_values[gate] = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
+            Wh_values[gate] = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
+            Wc_values[gate] = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
+
+        # Input and recurrent weights of all the gates, stored as (fan-in, gates*n_h) so that the
+        # scan step consumes them as T.dot(h_tm1, W_h) without transposing
+        self.W_x = shared_on_target(np.concatenate([Wx_values[gate] for gate in self.gates], axis=1), 'W_x', target)
+        self.W_h = shared_on_target(np.concatenate([Wh_values[gate] for gate in self.gates], axis=1), 'W_h', target)
+
+        # Peephole connections of input gate, forget gate and output gate
+        self.w_ci = shared_on_target(Wc_values['i'], 'w_ci', target)
+        self.w_cf = shared_on_target(Wc_values['f'], 'w_cf', target)
+        self.w_co = shared_on_target(Wc_values['o'], 'w_co', target)
 
         # bias
-        self.b_i = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_i')
-        self.b_f = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_f')
-        self.b_o = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_o')
-        self.b_c = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_c')
+        self.b = shared_on_target(np.zeros((len(self.gates)*n_h, ), dtype=config.floatX), 'b', target)
 
         ### make a layer
 
         # initial value of hidden and cell state
         if self.rnn_batch_training:
-            self.h0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'c0')
+            self.h0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'c0', target)
 
             self.h0 = T.repeat(self.h0, x.shape[1], 0)
             self.c0 = T.repeat(self.c0, x.shape[1], 0)
         else:
-            self.h0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'c0')
+            self.h0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'c0', target)
+
+        if not build_scan:
+            return
 
+        self.Wx = T.dot(self.input, self.W_x) + self.b
 
-        self.Wix = T.dot(self.input, self.W_xi)
-        self.Wfx = T.dot(self.input, self.W_xf)
-        self.Wcx = T.dot(self.input, self.W_xc)
-        self.Wox = T.dot(self.input, self.W_xo)
+        if reset is None:
+            step_fn, sequences = self.recurrent_fn, [self.Wx]
+        else:
+            step_fn, sequences = with_state_reset(self.recurrent_fn), [self.Wx, reset]
 
-        [self.h, self.c], _ = theano.scan(self.recurrent_fn, sequences = [self.Wix, self.Wfx, self.Wcx, self.Wox],
-                                                             outputs_info = [self.h0, self.c0])
+        [self.h, self.c], _ = theano.scan(step_fn, sequences = sequences,
+                                                   outputs_info = [self.h0, self.c0],
+                                                   non_sequences = [self.W_h])
 
         self.output = self.h
 
 
-    def recurrent_fn(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1 = None):
+    def gate(self, z, name):
+        """ Select the block of a single gate from a pre-activation computed with the concatenated weights.
+
+        :param z: pre-activation of all the gates, the gates are concatenated along the last axis
+        :param name: one of the characters in `self.gates`
+        """
+
+        k = self.gates.index(name)
+
+        return z[..., k*self.n_h:(k+1)*self.n_h]
+
+    def recurrent_fn(self, Wx, h_tm1, c_tm1, W_h):
         """ This implements a genetic recurrent function, called by self.__init__().
 
-        :param Wix: pre-computed matrix applying the weight matrix W on  the input units, for input gate
-        :param Wfx: Similar to Wix, but for forget gate
-        :param Wcx: Similar to Wix, but for cell memory
-        :param Wox: Similar to Wox, but for output gate
+        :param Wx: pre-computed matrix applying the weight matrix W_x on the input units plus the bias, for all the gates
         :param h_tm1: hidden activation from previous time step
         :param c_tm1: activation from cell memory from previous time step
+        :param W_h: the recurrent weight matrix, passed by scan as a non-sequence
         :returns: h_t is the hidden activation of current time step, and c_t is the activation for cell memory of current time step
         """
 
-        h_t, c_t = self.lstm_as_activation_function(Wix, Wfx, Wcx, Wox, h_tm1, c_tm1)
+        Wh = T.dot(h_tm1, W_h)
+
+        h_t, c_t = self.lstm_as_activation_function(Wx, Wh, h_tm1, c_tm1)
 
         return h_t, c_t
 
@@ -324,9 +363,13 @@ class LstmDecoderBase(object):
     """ This class provides as a base for all long short-term memory (LSTM) related classes.
     Several variants of LSTM were investigated in (Wu & King, ICASSP 2016): Zhizheng Wu, Simon King, "Investigating gated recurrent neural networks for speech synthesis", ICASSP 2016
 
+    As in :class:`layers.gating.LstmBase`, the input and recurrent weights of the gates are concatenated into W_x and W_h.
+
     """
 
-    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'ifoc'
+
+    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False, target=None):
         """ Initialise all the components in a LSTM block, including input gate, output gate, forget gate, peephole connections
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -337,8 +380,12 @@ class LstmDecoderBase(object):
         :type n_h: integer
         :param p: the probability of dropout
         :param training: a binary value to indicate training or testing (for dropout training)
+        :param target: name of the gpuarray context holding the parameters and computing the scan, None for the default device
         """
 
+        if target is not None:
+            x = x.transfer(target)
+
         self.input = x
 
         if p > 0.0:
@@ -353,101 +400,88 @@ class LstmDecoderBase(object):
 
         self.rnn_batch_training = rnn_batch_training
 
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
-        Wy_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_out), size=(n_out, n_h)), dtype=config.floatX)
+        # random initialisation of input gate, forget gate, output gate and cell weights, in this order
+        Wx_values = {}
+        Wh_values = {}
+        Wc_values = {}
+        for gate in 'ifoc':
+            Wx_values[gate] = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
+            Wh_values[gate] = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
+            Wc_values[gate] = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
 
-        # Input gate weights
-        self.W_xi = theano.shared(value=Wx_value, name='W_xi')
-        self.W_hi = theano.shared(value=Wh_value, name='W_hi')
-        self.w_ci = theano.shared(value=Wc_value, name='w_ci')
-        self.W_yi = theano.shared(value=Wy_value, name='W_yi')
+            if gate == 'i':
+                Wy_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_out), size=(n_out, n_h)), dtype=config.floatX)
+                Uh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_out)), dtype=config.floatX)
 
-        # random initialisation
-        Uh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_out)), dtype=config.floatX)
+        # Input and recurrent weights of all the gates, as in LstmBase
+        self.W_x = shared_on_target(np.concatenate([Wx_values[gate] for gate in self.gates], axis=1), 'W_x', target)
+        self.W_h = shared_on_target(np.concatenate([Wh_values[gate] for gate in self.gates], axis=1), 'W_h', target)
 
-        # Output gate weights
-        self.U_ho = theano.shared(value=Uh_value, name='U_ho')
+        # Peephole connections of input gate, forget gate and output gate
+        self.w_ci = shared_on_target(Wc_values['i'], 'w_ci', target)
+        self.w_cf = shared_on_target(Wc_values['f'], 'w_cf', target)
+        self.w_co = shared_on_target(Wc_values['o'], 'w_co', target)
 
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
+        # Feedback of the previous output to the cell
+        self.W_yi = shared_on_target(Wy_value, 'W_yi', target)
 
-        # Forget gate weights
-        self.W_xf = theano.shared(value=Wx_value, name='W_xf')
-        self.W_hf = theano.shared(value=Wh_value, name='W_hf')
-        self.w_cf = theano.shared(value=Wc_value, name='w_cf')
-
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
-
-        # Output gate weights
-        self.W_xo = theano.shared(value=Wx_value, name='W_xo')
-        self.W_ho = theano.shared(value=Wh_value, name='W_ho')
-        self.w_co = theano.shared(value=Wc_value, name='w_co')
-
-        # random initialisation
-        Wx_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX)
-        Wh_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX)
-        Wc_value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, )), dtype=config.floatX)
-
-        # Cell weights
-        self.W_xc = theano.shared(value=Wx_value, name='W_xc')
-        self.W_hc = theano.shared(value=Wh_value, name='W_hc')
+        # Output weights
+        self.U_ho = shared_on_target(Uh_value, 'U_ho', target)
 
         # bias
-        self.b_i = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_i')
-        self.b_f = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_f')
-        self.b_o = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_o')
-        self.b_c = theano.shared(value=np.zeros((n_h, ), dtype=config.floatX), name='b_c')
-        self.b   = theano.shared(value=np.zeros((n_out, ), dtype=config.floatX), name='b')
+        self.b_g = shared_on_target(np.zeros((len(self.gates)*self.n_h, ), dtype=config.floatX), 'b_g', target)
+        self.b   = shared_on_target(np.zeros((n_out, ), dtype=config.floatX), 'b', target)
 
         ### make a layer
 
         # initial value of hidden and cell state
         if self.rnn_batch_training:
-            self.h0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'c0')
-            self.y0 = theano.shared(value=np.zeros((1, n_out), dtype = config.floatX), name = 'y0')
+            self.h0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'c0', target)
+            self.y0 = shared_on_target(np.zeros((1, n_out), dtype = config.floatX), 'y0', target)
 
             self.h0 = T.repeat(self.h0, x.shape[1], 0)
             self.c0 = T.repeat(self.c0, x.shape[1], 0)
             self.y0 = T.repeat(self.c0, x.shape[1], 0)
         else:
-            self.h0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'c0')
-            self.y0 = theano.shared(value=np.zeros((n_out, ), dtype = config.floatX), name = 'y0')
+            self.h0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'c0', target)
+            self.y0 = shared_on_target(np.zeros((n_out, ), dtype = config.floatX), 'y0', target)
 
 
-        self.Wix = T.dot(self.input, self.W_xi)
-        self.Wfx = T.dot(self.input, self.W_xf)
-        self.Wcx = T.dot(self.input, self.W_xc)
-        self.Wox = T.dot(self.input, self.W_xo)
+        self.Wx = T.dot(self.input, self.W_x) + self.b_g
 
-        [self.h, self.c, self.y], _ = theano.scan(self.recurrent_fn, sequences = [self.Wix, self.Wfx, self.Wcx, self.Wox],
-                                                             outputs_info = [self.h0, self.c0, self.y0])
+        [self.h, self.c, self.y], _ = theano.scan(self.recurrent_fn, sequences = [self.Wx],
+                                                             outputs_info = [self.h0, self.c0, self.y0],
+                                                             non_sequences = [self.W_h])
 
         self.output = self.y
 
 
-    def recurrent_fn(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1=None, y_tm1=None):
+    def gate(self, z, name):
+        """ Select the block of a single gate from a pre-activation computed with the concatenated weights.
+        See :func:`layers.gating.LstmBase.gate`
+
+        """
+
+        k = self.gates.index(name)
+
+        return z[..., k*self.n_h:(k+1)*self.n_h]
+
+    def recurrent_fn(self, Wx, h_tm1, c_tm1, y_tm1, W_h):
         """ This implements a genetic recurrent function, called by self.__init__().
 
-        :param Wix: pre-computed matrix applying the weight matrix W on  the input units, for input gate
-        :param Wfx: Similar to Wix, but for forget gate
-        :param Wcx: Similar to Wix, but for cell memory
-        :param Wox: Similar to Wox, but for output gate
+        :param Wx: pre-computed matrix applying the weight matrix W_x on the input units plus the bias, for all the gates
         :param h_tm1: hidden activation from previous time step
         :param c_tm1: activation from cell memory from previous time step
+        :param y_tm1: output from previous time step
+        :param W_h: the recurrent weight matrix, passed by scan as a non-sequence
         :returns: h_t is the hidden activation of current time step, and c_t is the activation for cell memory of current time step
         """
 
-        h_t, c_t, y_t = self.lstm_as_activation_function(Wix, Wfx, Wcx, Wox, h_tm1, c_tm1, y_tm1)
+        Wh = T.dot(h_tm1, W_h)
+
+        h_t, c_t, y_t = self.lstm_as_activation_function(Wx, Wh, h_tm1, c_tm1, y_tm1)
 
         return h_t, c_t, y_t
 
@@ -463,8 +497,9 @@ class VanillaLstm(LstmBase):
 
     """
 
+    gates = 'ifoc'
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise a vanilla LSTM block
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -473,28 +508,31 @@ class VanillaLstm(LstmBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmBase`
+        :param reset: the reset mask of packed sequences, see :class:`layers.gating.LstmBase`
+        :param build_scan: False when the time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
-        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training)
+        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training, target, reset, build_scan)
 
-        self.params = [self.W_xi, self.W_hi, self.w_ci,
-                       self.W_xf, self.W_hf, self.w_cf,
-                       self.W_xo, self.W_ho, self.w_co,
-                       self.W_xc, self.W_hc,
-                       self.b_i, self.b_f, self.b_o, self.b_c]
+        self.params = [self.W_x, self.W_h,
+                       self.w_ci, self.w_cf, self.w_co,
+                       self.b]
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1):
         """ This function treats the LSTM block as an activation function, and implements the standard LSTM activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
 
-        i_t = T.nnet.sigmoid(Wix + T.dot(h_tm1, self.W_hi) + self.w_ci * c_tm1 + self.b_i)  #
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.w_cf * c_tm1 + self.b_f)  #
+        z = Wx + Wh
 
-        c_t = f_t * c_tm1 + i_t * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + self.b_c)
+        i_t = T.nnet.sigmoid(self.gate(z, 'i') + self.w_ci * c_tm1)  #
+        f_t = T.nnet.sigmoid(self.gate(z, 'f') + self.w_cf * c_tm1)  #
 
-        o_t = T.nnet.sigmoid(Wox + T.dot(h_tm1, self.W_ho) + self.w_co * c_t + self.b_o)
+        c_t = f_t * c_tm1 + i_t * T.tanh(self.gate(z, 'c'))
+
+        o_t = T.nnet.sigmoid(self.gate(z, 'o') + self.w_co * c_t)
 
         h_t = o_t * T.tanh(c_t)
 
@@ -505,8 +543,9 @@ class VanillaLstmDecoder(LstmDecoderBase):
 
     """
 
+    gates = 'ifoc'
 
-    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False):
+    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False, target=None):
         """ Initialise a vanilla LSTM block
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -515,31 +554,32 @@ class VanillaLstmDecoder(LstmDecoderBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmDecoderBase`
         """
 
         self.n_out = int(n_out)
 
-        LstmDecoderBase.__init__(self, rng, x, n_in, n_h, n_out, p, training, rnn_batch_training)
+        LstmDecoderBase.__init__(self, rng, x, n_in, n_h, n_out, p, training, rnn_batch_training, target)
 
-        self.params = [self.W_xi, self.W_hi, self.w_ci, self.W_yi,
-                       self.W_xf, self.W_hf, self.w_cf,
-                       self.W_xo, self.W_ho, self.w_co,
-                       self.W_xc, self.W_hc,
-                       self.U_ho,
-                       self.b_i, self.b_f, self.b_o, self.b_c, self.b]
+        self.params = [self.W_x, self.W_h,
+                       self.w_ci, self.w_cf, self.w_co,
+                       self.W_yi, self.U_ho,
+                       self.b_g, self.b]
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1, y_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1, y_tm1):
         """ This function treats the LSTM block as an activation function, and implements the standard LSTM activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
 
-        i_t = T.nnet.sigmoid(Wix + T.dot(h_tm1, self.W_hi) + self.w_ci * c_tm1 + self.b_i)  #
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.w_cf * c_tm1 + self.b_f)  #
+        z = Wx + Wh
+
+        i_t = T.nnet.sigmoid(self.gate(z, 'i') + self.w_ci * c_tm1)  #
+        f_t = T.nnet.sigmoid(self.gate(z, 'f') + self.w_cf * c_tm1)  #
 
-        c_t = f_t * c_tm1 + i_t * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + T.dot(y_tm1, self.W_yi) + self.b_c)
+        c_t = f_t * c_tm1 + i_t * T.tanh(self.gate(z, 'c') + T.dot(y_tm1, self.W_yi))
 
-        o_t = T.nnet.sigmoid(Wox + T.dot(h_tm1, self.W_ho) + self.w_co * c_t + self.b_o)
+        o_t = T.nnet.sigmoid(self.gate(z, 'o') + self.w_co * c_t)
 
         h_t = o_t * T.tanh(c_t)
 
@@ -552,7 +592,9 @@ class SimplifiedLstmDecoder(LstmDecoderBase):
     
     """
 
-    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'fc'
+
+    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False, target=None):
         """ Initialise a LSTM with only the forget gate
         
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -561,27 +603,28 @@ class SimplifiedLstmDecoder(LstmDecoderBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmDecoderBase`
         """
         
         self.n_out = int(n_out)
 
-        LstmDecoderBase.__init__(self, rng, x, n_in, n_h, n_out, p, training, rnn_batch_training)
+        LstmDecoderBase.__init__(self, rng, x, n_in, n_h, n_out, p, training, rnn_batch_training, target)
 
-        self.params = [self.W_yi,
-                       self.W_xf, self.W_hf,
-                       self.W_xc, self.W_hc,
-                       self.U_ho,
-                       self.b_f,  self.b_c, self.b]
+        self.params = [self.W_x, self.W_h,
+                       self.W_yi, self.U_ho,
+                       self.b_g, self.b]
                        
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1, y_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1, y_tm1):
         """ This function treats the LSTM block as an activation function, and implements the LSTM (simplified LSTM) activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
         
         """
+
+        z = Wx + Wh
+
+        f_t = T.nnet.sigmoid(self.gate(z, 'f'))  #self.w_cf * c_tm1 
     
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.b_f)  #self.w_cf * c_tm1 
-    
-        c_t = f_t * c_tm1 + (1 - f_t) * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + T.dot(y_tm1, self.W_yi) + self.b_c) 
+        c_t = f_t * c_tm1 + (1 - f_t) * T.tanh(self.gate(z, 'c') + T.dot(y_tm1, self.W_yi)) 
 
         h_t = T.tanh(c_t)
 
@@ -593,7 +636,10 @@ class LstmNFG(LstmBase):
     """ This class implements a LSTM block without the forget gate, inheriting the genetic class :class:`layers.gating.LstmBase`.
 
     """
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+
+    gates = 'ioc'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise a LSTM with the forget gate
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -602,26 +648,30 @@ class LstmNFG(LstmBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmBase`
+        :param reset: the reset mask of packed sequences, see :class:`layers.gating.LstmBase`
+        :param build_scan: False when the time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
-        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training)
+        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training, target, reset, build_scan)
 
-        self.params = [self.W_xi, self.W_hi, self.w_ci,
-                       self.W_xo, self.W_ho, self.w_co,
-                       self.W_xc, self.W_hc,
-                       self.b_i, self.b_o, self.b_c]
+        self.params = [self.W_x, self.W_h,
+                       self.w_ci, self.w_co,
+                       self.b]
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1):
         """ This function treats the LSTM block as an activation function, and implements the LSTM (without the forget gate) activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
 
-        i_t = T.nnet.sigmoid(Wix + T.dot(h_tm1, self.W_hi) + self.w_ci * c_tm1 + self.b_i)  #
+        z = Wx + Wh
 
-        c_t = c_tm1 + i_t * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + self.b_c)  #f_t *
+        i_t = T.nnet.sigmoid(self.gate(z, 'i') + self.w_ci * c_tm1)  #
 
-        o_t = T.nnet.sigmoid(Wox + T.dot(h_tm1, self.W_ho) + self.w_co * c_t + self.b_o)
+        c_t = c_tm1 + i_t * T.tanh(self.gate(z, 'c'))  #f_t *
+
+        o_t = T.nnet.sigmoid(self.gate(z, 'o') + self.w_co * c_t)
 
         h_t = o_t * T.tanh(c_t)
 
@@ -632,7 +682,9 @@ class LstmNIG(LstmBase):
 
     """
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'foc'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise a LSTM with the input gate
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -641,26 +693,30 @@ class LstmNIG(LstmBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmBase`
+        :param reset: the reset mask of packed sequences, see :class:`layers.gating.LstmBase`
+        :param build_scan: False when the time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
-        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training)
+        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training, target, reset, build_scan)
 
-        self.params = [self.W_xf, self.W_hf, self.w_cf,
-                       self.W_xo, self.W_ho, self.w_co,
-                       self.W_xc, self.W_hc,
-                       self.b_f, self.b_o, self.b_c]
+        self.params = [self.W_x, self.W_h,
+                       self.w_cf, self.w_co,
+                       self.b]
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1):
         """ This function treats the LSTM block as an activation function, and implements the LSTM (without the input gate) activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
 
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.w_cf * c_tm1 + self.b_f)  #
+        z = Wx + Wh
+
+        f_t = T.nnet.sigmoid(self.gate(z, 'f') + self.w_cf * c_tm1)  #
 
-        c_t = f_t * c_tm1 + T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + self.b_c)  #i_t *
+        c_t = f_t * c_tm1 + T.tanh(self.gate(z, 'c'))  #i_t *
 
-        o_t = T.nnet.sigmoid(Wox + T.dot(h_tm1, self.W_ho) + self.w_co * c_t + self.b_o)
+        o_t = T.nnet.sigmoid(self.gate(z, 'o') + self.w_co * c_t)
 
         h_t = o_t * T.tanh(c_t)
 
@@ -672,7 +728,9 @@ class LstmNOG(LstmBase):
 
     """
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'ifc'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise a LSTM with the output gate
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -681,26 +739,29 @@ class LstmNOG(LstmBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmBase`
+        :param reset: the reset mask of packed sequences, see :class:`layers.gating.LstmBase`
+        :param build_scan: False when the time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
-        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training)
+        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training, target, reset, build_scan)
 
-        self.params = [self.W_xi, self.W_hi, self.w_ci,
-                       self.W_xf, self.W_hf, self.w_cf,
-                       self.W_xc, self.W_hc,
-                       self.b_i, self.b_f,
-                       self.b_c]
+        self.params = [self.W_x, self.W_h,
+                       self.w_ci, self.w_cf,
+                       self.b]
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1):
         """ This function treats the LSTM block as an activation function, and implements the LSTM (without the output gate) activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
 
-        i_t = T.nnet.sigmoid(Wix + T.dot(h_tm1, self.W_hi) + self.w_ci * c_tm1 + self.b_i)  #
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.w_cf * c_tm1 + self.b_f)  #
+        z = Wx + Wh
+
+        i_t = T.nnet.sigmoid(self.gate(z, 'i') + self.w_ci * c_tm1)  #
+        f_t = T.nnet.sigmoid(self.gate(z, 'f') + self.w_cf * c_tm1)  #
 
-        c_t = f_t * c_tm1 + i_t * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + self.b_c)  #i_t *
+        c_t = f_t * c_tm1 + i_t * T.tanh(self.gate(z, 'c'))  #i_t *
 
         h_t = T.tanh(c_t)
 
@@ -712,7 +773,9 @@ class LstmNoPeepholes(LstmBase):
 
     """
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'ifoc'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise a LSTM with the peephole connections
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -721,29 +784,30 @@ class LstmNoPeepholes(LstmBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmBase`
+        :param reset: the reset mask of packed sequences, see :class:`layers.gating.LstmBase`
+        :param build_scan: False when the time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
-        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training)
+        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training, target, reset, build_scan)
 
-        self.params = [self.W_xi, self.W_hi, #self.W_ci,
-                       self.W_xf, self.W_hf, #self.W_cf,
-                       self.W_xo, self.W_ho, #self.W_co,
-                       self.W_xc, self.W_hc,
-                       self.b_i, self.b_f,
-                       self.b_o, self.b_c]
+        self.params = [self.W_x, self.W_h, #self.W_ci, self.W_cf, self.W_co,
+                       self.b]
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1):
         """ This function treats the LSTM block as an activation function, and implements the LSTM (without the output gate) activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
 
-        i_t = T.nnet.sigmoid(Wix + T.dot(h_tm1, self.W_hi) + self.b_i)
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.b_f)
+        z = Wx + Wh
 
-        c_t = f_t * c_tm1 + i_t * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + self.b_c)
+        i_t = T.nnet.sigmoid(self.gate(z, 'i'))
+        f_t = T.nnet.sigmoid(self.gate(z, 'f'))
 
-        o_t = T.nnet.sigmoid(Wox + T.dot(h_tm1, self.W_ho) + self.b_o)
+        c_t = f_t * c_tm1 + i_t * T.tanh(self.gate(z, 'c'))
+
+        o_t = T.nnet.sigmoid(self.gate(z, 'o'))
 
         h_t = o_t * T.tanh(c_t)
 
@@ -755,7 +819,9 @@ class SimplifiedLstm(LstmBase):
 
     """
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'fc'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise a LSTM with only the forget gate
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -764,25 +830,29 @@ class SimplifiedLstm(LstmBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmBase`
+        :param reset: the reset mask of packed sequences, see :class:`layers.gating.LstmBase`
+        :param build_scan: False when the time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
-        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training)
+        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training, target, reset, build_scan)
 
-        self.params = [self.W_xf, self.W_hf,
-                       self.W_xc, self.W_hc,
-                       self.b_f,  self.b_c]
+        self.params = [self.W_x, self.W_h,
+                       self.b]
 
-        self.L2_cost = (self.W_xf ** 2).sum() + (self.W_hf ** 2).sum() + (self.W_xc ** 2).sum() + (self.W_hc ** 2).sum()
+        self.L2_cost = (self.W_x ** 2).sum() + (self.W_h ** 2).sum()
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1):
         """ This function treats the LSTM block as an activation function, and implements the LSTM (simplified LSTM) activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
 
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.b_f)  #self.w_cf * c_tm1
+        z = Wx + Wh
+
+        f_t = T.nnet.sigmoid(self.gate(z, 'f'))  #self.w_cf * c_tm1
 
-        c_t = f_t * c_tm1 + (1 - f_t) * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + self.b_c)
+        c_t = f_t * c_tm1 + (1 - f_t) * T.tanh(self.gate(z, 'c'))
 
         h_t = T.tanh(c_t)
 
@@ -793,7 +863,9 @@ class SimplifiedGRU(LstmBase):
 
     """
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'fc'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None, build_scan=True):
         """ Initialise a LSTM with the the forget gate
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -802,26 +874,28 @@ class SimplifiedGRU(LstmBase):
         :type n_in: integer
         :param n_h: number of hidden units
         :type n_h: integer
+        :param target: name of the gpuarray context to place the block on, see :class:`layers.gating.LstmBase`
+        :param reset: the reset mask of packed sequences, see :class:`layers.gating.LstmBase`
+        :param build_scan: False when the time steps are computed by the fused scan of :class:`layers.gating.BidirectionBase`
         """
 
-        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training)
+        LstmBase.__init__(self, rng, x, n_in, n_h, p, training, rnn_batch_training, target, reset, build_scan)
 
-        self.params = [self.W_xf, self.W_hf, self.w_cf,
-                       self.W_xc, self.W_hc,
-                       self.b_f,  self.b_c]
+        self.params = [self.W_x, self.W_h, self.w_cf,
+                       self.b]
 
-        self.L2_cost = (self.W_xf ** 2).sum() + (self.W_hf ** 2).sum() + (self.W_xc ** 2).sum() + (self.W_hc ** 2).sum()
+        self.L2_cost = (self.W_x ** 2).sum() + (self.W_h ** 2).sum()
 
-    def lstm_as_activation_function(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1):
+    def lstm_as_activation_function(self, Wx, Wh, h_tm1, c_tm1):
         """ This function treats the LSTM block as an activation function, and implements the LSTM (simplified LSTM) activation function.
             The meaning of each input and output parameters can be found in :func:`layers.gating.LstmBase.recurrent_fn`
 
         """
         ##can_h_t = T.tanh(Whx + r_t * T.dot(h_tm1, self.W_hh) + self.b_h)
 
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.b_f)  #self.w_cf * c_tm1
+        f_t = T.nnet.sigmoid(self.gate(Wx, 'f') + self.gate(Wh, 'f'))  #self.w_cf * c_tm1
 
-        can_h_t = T.tanh(Wcx + f_t * T.dot(h_tm1, self.W_hc) + self.b_c)
+        can_h_t = T.tanh(self.gate(Wx, 'c') + f_t * self.gate(Wh, 'c'))
 
         h_t = self.w_cf * (1.0 - f_t) * h_tm1 + f_t * can_h_t
         c_t = h_t
@@ -832,28 +906,202 @@ class SimplifiedGRU(LstmBase):
 
         return h_t, c_t
 
-class BidirectionSLstm(SimplifiedLstm):
+class BidirectionBase(object):
+    """ This class provides as a base for the bidirectional LSTM blocks, which are combined with the class of the cell, e.g. :class:`layers.gating.VanillaLstm`.
 
-    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False):
+    The two directions run as one scan over a doubled batch: their inputs are stacked along a leading axis of size 2,
+    the input weights of both directions are applied with a single batched matrix product, and each time step applies
+    the stacked recurrent weights with one batched matrix product. The activation function of the cell is reused on the
+    stacked states, with the peephole connections stacked in the same way.
 
-        fwd = SimplifiedLstm(rng, x, n_in, n_h, p, training, rnn_batch_training)
-        bwd = SimplifiedLstm(rng, x[::-1], n_in, n_h, p, training, rnn_batch_training)
+    """
 
-        self.params = fwd.params + bwd.params
+    cell = None
+
+    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False, targets=None, resets=None):
+        """ Initialise a bidirectional block
 
-        self.output = T.concatenate([fwd.output, bwd.output[::-1]], axis=-1)
+        :param targets: a pair of gpuarray context names for the forward and the backward direction, so that the
+                        two scans run concurrently. The outputs are concatenated on the context of the forward direction.
+        :param resets: a pair of reset masks of packed sequences for the forward and the backward direction, the mask of
+                       the backward direction is in reversed time, see :class:`layers.gating.LstmBase`
+        """
 
-class BidirectionLstm(VanillaLstm):
+        fwd_target, bwd_target = targets if targets is not None else (None, None)
+        fwd_reset, bwd_reset = resets if resets is not None else (None, None)
 
-    def __init__(self, rng, x, n_in, n_h, n_out, p=0.0, training=0, rnn_batch_training=False):
+        # the directions on the same device run as one fused scan, instead of the scans of their cells
+        fused = bwd_target == fwd_target
 
-        fwd = VanillaLstm(rng, x, n_in, n_h, p, training, rnn_batch_training)
-        bwd = VanillaLstm(rng, x[::-1], n_in, n_h, p, training, rnn_batch_training)
+        # the cells hold the parameters and the dropout of each direction
+        fwd = self.cell(rng, x, n_in, n_h, p, training, rnn_batch_training, fwd_target, fwd_reset, not fused)
+        bwd = self.cell(rng, x[::-1], n_in, n_h, p, training, rnn_batch_training, bwd_target, bwd_reset, not fused)
 
         self.params = fwd.params + bwd.params
 
-        self.output = T.concatenate([fwd.output, bwd.output[::-1]], axis=-1)
+        self.n_in = fwd.n_in
+        self.n_h  = fwd.n_h
+
+        self.rnn_batch_training = rnn_batch_training
+
+        if not fused:
+            # the directions are on different devices, each runs the scan of its cell
+            bwd_output = bwd.output[::-1].transfer(fwd_target)
+            self.output = T.concatenate([fwd.output, bwd_output], axis=-1)
+            return
+
+        for name in ['w_ci', 'w_cf', 'w_co']:
+            if hasattr(fwd, name):
+                peephole = T.stack([getattr(fwd, name), getattr(bwd, name)])
+                if rnn_batch_training:
+                    peephole = peephole.dimshuffle(0, 'x', 1)
+                setattr(self, name, peephole)
+
+        W_x = T.stack([fwd.W_x, bwd.W_x])
+        W_h = T.stack([fwd.W_h, bwd.W_h])
+        b   = T.stack([fwd.b, bwd.b])
+
+        # (2, n_frames, n_in) or (2, n_frames*batch_size, n_in), with the reversed input as the second direction
+        inputs = T.stack([fwd.input, bwd.input])
+        Wx = T.batched_dot(T.reshape(inputs, (2, -1, self.n_in)), W_x) + b.dimshuffle(0, 'x', 1)
+
+        # scan over the time steps, with the directions inside each step
+        if rnn_batch_training:
+            Wx = T.reshape(Wx, (2, x.shape[0], x.shape[1], Wx.shape[-1])).dimshuffle(1, 0, 2, 3)
+        else:
+            Wx = Wx.dimshuffle(1, 0, 2)
+
+        h0 = T.stack([fwd.h0, bwd.h0])
+        c0 = T.stack([fwd.c0, bwd.c0])
+
+        if resets is None:
+            step_fn, sequences = self.recurrent_fn, [Wx]
+        else:
+            # (n_frames, 2, 1), broadcast over the units of each direction
+            reset = T.stack([fwd_reset, bwd_reset], axis=1).dimshuffle(0, 1, 'x')
+            step_fn, sequences = with_state_reset(self.recurrent_fn), [Wx, reset]
+
+        [h, c], _ = theano.scan(step_fn, sequences = sequences,
+                                         outputs_info = [h0, c0],
+                                         non_sequences = [W_h])
+
+        self.output = T.concatenate([h[:, 0], h[:, 1][::-1]], axis=-1)
+
+    def recurrent_fn(self, Wx, h_tm1, c_tm1, W_h):
+        """ This implements the recurrent function of both directions, see :func:`layers.gating.LstmBase.recurrent_fn`
+
+        :param W_h: the recurrent weight matrices of the two directions, stacked as (2, n_h, gates*n_h)
+        """
+
+        Wh = T.batched_dot(h_tm1, W_h)
+
+        h_t, c_t = self.lstm_as_activation_function(Wx, Wh, h_tm1, c_tm1)
+
+        return h_t, c_t
+
+class BidirectionSLstm(BidirectionBase, SimplifiedLstm):
+    """ This class implements a bidirectional simplified LSTM block, see :class:`layers.gating.BidirectionBase`
+
+    """
+
+    cell = SimplifiedLstm
+
+class BidirectionLstm(BidirectionBase, VanillaLstm):
+    """ This class implements a bidirectional LSTM block, see :class:`layers.gating.BidirectionBase`
+
+    """
+
+    cell = VanillaLstm
+
+
+def cudnn_rnn_available():
+    """ Check whether :class:`layers.gating.CuDNNRNNLayer` can be used, i.e. theano runs on a CUDA device with cuDNN.
+
+    """
+
+    if not config.device.startswith('cuda'):
+        return False
+
+    from theano.gpuarray import dnn
+
+    return dnn.dnn_available(None)
+
+class CuDNNRNNLayer(object):
+    """ This class wraps the cuDNN recurrent layers (theano.gpuarray.dnn.RNNBlock), which compute all the time steps of a
+    LSTM or GRU layer in one fused kernel instead of a theano.scan. All the weights and biases are packed into a single
+    parameter vector whose layout is defined by cuDNN.
+
+    The cuDNN LSTM has no peephole connections, i.e. it corresponds to :class:`layers.gating.LstmNoPeepholes`.
+    The cuDNN GRU applies the reset gate after the recurrent matrix product, as :class:`layers.gating.GatedRecurrentUnit`.
+
+    """
+
+    def __init__(self, rng, x, n_in, n_h, rnn_mode='lstm', direction_mode='unidirectional', p=0.0, training=0, rnn_batch_training=False):
+        """ Initialise a cuDNN recurrent layer
+
+        :param rng: random state, fixed value for randome state for reproducible objective results
+        :param x: input to a network
+        :param n_in: number of input features
+        :type n_in: integer
+        :param n_h: number of hidden units
+        :type n_h: integer
+        :param rnn_mode: 'lstm' or 'gru'
+        :param direction_mode: 'unidirectional' or 'bidirectional', the output of a bidirectional layer has 2*n_h dimensions
+        :param p: the probability of dropout
+        :param training: a binary value to indicate training or testing (for dropout training)
+        """
+
+        from theano.gpuarray import dnn
+        from theano.gpuarray.type import gpuarray_shared_constructor
 
+        self.input = x
+
+        if p > 0.0:
+            if training==1:
+                srng = RandomStreams(seed=123456)
+                self.input = T.switch(srng.binomial(size=x.shape,p=p), x, 0)
+            else:
+                self.input =  (1-p) * x
+
+        self.n_in = int(n_in)
+        self.n_h  = int(n_h)
+
+        self.rnn_batch_training = rnn_batch_training
+        self.direction_mode = direction_mode
+
+        n_dirs = 2 if direction_mode == 'bidirectional' else 1
+
+        self.rnn_block = dnn.RNNBlock(config.floatX, self.n_h, 1, rnn_mode, input_mode='linear', direction_mode=direction_mode)
+
+        param_size = self.rnn_block.get_param_size([1, self.n_in])
+        self.W = gpuarray_shared_constructor(np.zeros((param_size, ), dtype=config.floatX), name='W')
+
+        # random initialisation of the weight matrices of each direction, the biases stay at zero
+        for layer in range(n_dirs):
+            layer_params = self.rnn_block.split_params(self.W, layer, [1, self.n_in])
+            for W_value in layer_params[0::2]:
+                W_value[:] = np.asarray(rng.normal(0.0, 1.0/np.sqrt(W_value.shape[0]), size=W_value.shape), dtype=config.floatX)
+
+        # cuDNN works on (time, batch, feature) tensors
+        if self.rnn_batch_training:
+            rnn_input = self.input
+        else:
+            rnn_input = self.input.dimshuffle(0, 'x', 1)
+
+        self.h0 = T.zeros((n_dirs, rnn_input.shape[1], self.n_h), dtype=config.floatX)
+
+        if rnn_mode == 'lstm':
+            self.c0 = T.zeros((n_dirs, rnn_input.shape[1], self.n_h), dtype=config.floatX)
+            self.h = self.rnn_block.apply(self.W, rnn_input, self.h0, self.c0)[0]
+        else:
+            self.h = self.rnn_block.apply(self.W, rnn_input, self.h0)[0]
+
+        if self.rnn_batch_training:
+            self.output = self.h
+        else:
+            self.output = self.h[:, 0, :]
+
+        self.params = [self.W]
 
 class RecurrentOutput(object):
     def __init__(self, rng, x, n_in, n_out, p=0.0, training=0, rnn_batch_training=False):
@@ -869,10 +1117,13 @@ class RecurrentOutput(object):
 # Gated Recurrent Unit
 class GatedRecurrentUnit(object):
     """ This class implements a gated recurrent unit (GRU), as proposed in Cho et al 2014 (http://arxiv.org/pdf/1406.1078.pdf).
+    The weights of the update gate, reset gate and candidate activation are concatenated, with the order given by `gates`.
 
     """
 
-    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False):
+    gates = 'zrh'
+
+    def __init__(self, rng, x, n_in, n_h, p=0.0, training=0, rnn_batch_training=False, target=None, reset=None):
         """ Initialise a gated recurrent unit
 
         :param rng: random state, fixed value for randome state for reproducible objective results
@@ -883,6 +1134,8 @@ class GatedRecurrentUnit(object):
         :type n_h: integer
         :param p: the probability of dropout
         :param training: a binary value to indicate training or testing (for dropout training)
+        :param target: name of the gpuarray context holding the parameters and computing the scan, None for the default device
+        :param reset: a vector with 1 at the first frame of each sequence packed in x, where the states are reset to zero, None for a single sequence
         """
 
         self.n_in = int(n_in)
@@ -890,6 +1143,11 @@ class GatedRecurrentUnit(object):
 
         self.rnn_batch_training = rnn_batch_training
 
+        if target is not None:
+            x = x.transfer(target)
+            if reset is not None:
+                reset = reset.transfer(target)
+
         self.input = x
 
         if p > 0.0:
@@ -899,66 +1157,73 @@ class GatedRecurrentUnit(object):
             else:
                 self.input =  (1-p) * x
 
-        self.W_xz = theano.shared(value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in),
-                     size=(n_in, n_h)), dtype=config.floatX), name = 'W_xz')
-        self.W_hz = theano.shared(value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h),
-                     size=(n_h, n_h)), dtype=config.floatX), name = 'W_hz')
+        # random initialisation of update gate, reset gate and candidate weights, in this order
+        Wx_values = []
+        Wh_values = []
+        for gate in self.gates:
+            Wx_values.append(np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in), size=(n_in, n_h)), dtype=config.floatX))
+            Wh_values.append(np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h), size=(n_h, n_h)), dtype=config.floatX))
 
-        self.W_xr = theano.shared(value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in),
-                     size=(n_in, n_h)), dtype=config.floatX), name = 'W_xr')
-        self.W_hr = theano.shared(value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h),
-                     size=(n_h, n_h)), dtype=config.floatX), name = 'W_hr')
+        # Input and recurrent weights of all the gates, as in LstmBase
+        self.W_x = shared_on_target(np.concatenate(Wx_values, axis=1), 'W_x', target)
+        self.W_h = shared_on_target(np.concatenate(Wh_values, axis=1), 'W_h', target)
 
-        self.W_xh = theano.shared(value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_in),
-                     size=(n_in, n_h)), dtype=config.floatX), name = 'W_xh')
-        self.W_hh = theano.shared(value = np.asarray(rng.normal(0.0, 1.0/np.sqrt(n_h),
-                     size=(n_h, n_h)), dtype=config.floatX), name = 'W_hh')
-
-        self.b_z = theano.shared(value = np.zeros((n_h, ), dtype = config.floatX), name = 'b_z')
-
-        self.b_r = theano.shared(value = np.zeros((n_h, ), dtype = config.floatX), name = 'b_r')
-
-        self.b_h = theano.shared(value = np.zeros((n_h, ), dtype = config.floatX), name = 'b_h')
+        self.b = shared_on_target(np.zeros((len(self.gates)*self.n_h, ), dtype = config.floatX), 'b', target)
 
         if self.rnn_batch_training:
-            self.h0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((1, n_h), dtype = config.floatX), name = 'c0')
+            self.h0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((1, n_h), dtype = config.floatX), 'c0', target)
 
             self.h0 = T.repeat(self.h0, x.shape[1], 0)
             self.c0 = T.repeat(self.c0, x.shape[1], 0)
         else:
-            self.h0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'h0')
-            self.c0 = theano.shared(value=np.zeros((n_h, ), dtype = config.floatX), name = 'c0')
+            self.h0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'h0', target)
+            self.c0 = shared_on_target(np.zeros((n_h, ), dtype = config.floatX), 'c0', target)
 
 
-        ## pre-compute these for fast computation
-        self.Wzx = T.dot(self.input, self.W_xz)
-        self.Wrx = T.dot(self.input, self.W_xr)
-        self.Whx = T.dot(self.input, self.W_xh)
+        ## pre-compute this for fast computation
+        self.Wx = T.dot(self.input, self.W_x) + self.b
 
-        [self.h, self.c], _ = theano.scan(self.gru_as_activation_function,
-                                               sequences = [self.Wzx, self.Wrx, self.Whx],
-                                               outputs_info = [self.h0, self.c0])  #
+        if reset is None:
+            step_fn, sequences = self.gru_as_activation_function, [self.Wx]
+        else:
+            step_fn, sequences = with_state_reset(self.gru_as_activation_function), [self.Wx, reset]
+
+        [self.h, self.c], _ = theano.scan(step_fn,
+                                               sequences = sequences,
+                                               outputs_info = [self.h0, self.c0],
+                                               non_sequences = [self.W_h])  #
 
 
         self.output = self.h
 
-        self.params = [self.W_xz, self.W_hz, self.W_xr, self.W_hr, self.W_xh, self.W_hh,
-                       self.b_z, self.b_r, self.b_h]
+        self.params = [self.W_x, self.W_h, self.b]
+
+        self.L2_cost = (self.W_x ** 2).sum() + (self.W_h ** 2).sum()
 
-        self.L2_cost = (self.W_xz ** 2).sum() + (self.W_hz ** 2).sum() + (self.W_xr ** 2).sum() + (self.W_hr ** 2).sum() + (self.W_xh ** 2).sum() + (self.W_hh ** 2).sum()
+    def gate(self, z, name):
+        """ Select the block of a single gate from a pre-activation computed with the concatenated weights.
+        See :func:`layers.gating.LstmBase.gate`
 
-    def gru_as_activation_function(self, Wzx, Wrx, Whx, h_tm1, c_tm1 = None):
+        """
+
+        k = self.gates.index(name)
+
+        return z[..., k*self.n_h:(k+1)*self.n_h]
+
+    def gru_as_activation_function(self, Wx, h_tm1, c_tm1, W_h):
         """ This function treats the GRU block as an activation function, and implements the GRU activation function.
             This function is called by :func:`layers.gating.GatedRecurrentUnit.__init__`.
-            Wzx, Wrx, Whx have been pre-computed before passing to this function.
+            Wx, the input projection of all the gates plus the bias, has been pre-computed before passing to this function.
 
             To make the same interface as LSTM, we keep a c_tm1 (means the cell state of previous time step, but GRU does not maintain a cell state).
         """
 
-        z_t = T.nnet.sigmoid(Wzx + T.dot(h_tm1, self.W_hz) + self.b_z)
-        r_t = T.nnet.sigmoid(Wrx + T.dot(h_tm1, self.W_hr) + self.b_r)
-        can_h_t = T.tanh(Whx + r_t * T.dot(h_tm1, self.W_hh) + self.b_h)
+        Wh = T.dot(h_tm1, W_h)
+
+        z_t = T.nnet.sigmoid(self.gate(Wx, 'z') + self.gate(Wh, 'z'))
+        r_t = T.nnet.sigmoid(self.gate(Wx, 'r') + self.gate(Wh, 'r'))
+        can_h_t = T.tanh(self.gate(Wx, 'h') + r_t * self.gate(Wh, 'h'))
 
         h_t = (1 - z_t) * h_tm1 + z_t * can_h_t
 
@@ -44,10 +44,42 @@ import theano
 import theano.tensor as T
 from theano.tensor.shared_randomstreams import RandomStreams
 from theano.ifelse import ifelse 
+from collections import OrderedDict
 
 import logging
 
 
+def shared_on_target(value, name, target=None, **kwargs):
+    """ Create a shared variable, placed on the gpuarray context `target` when one is given.
+
+    :param value: initial value of the shared variable
+    :param name: name of the shared variable
+    :param target: name of a context declared in theano's `contexts` flag, None for the default device
+    """
+
+    if target is None:
+        return theano.shared(value=value, name=name, **kwargs)
+
+    return theano.shared(value=value, name=name, target=target, **kwargs)
+
+def target_of(variable):
+    """ Return the gpuarray context name a variable is placed on, None for the default device, see :func:`shared_on_target`
+    """
+
+    return getattr(variable.type, 'context_name', None)
+
+def group_by_target(params):
+    """ Group the indices of params by the gpuarray context each parameter is placed on, in the order of params
+
+    :returns: an OrderedDict from the context name, None for the default device, to the list of indices in params
+    """
+
+    groups = OrderedDict()
+    for index, param in enumerate(params):
+        groups.setdefault(target_of(param), []).append(index)
+
+    return groups
+
 class MixtureDensityOutputLayer(object):
     def __init__(self, rng, input, n_in, n_out, n_component, var_floor):
         self.input = input
@@ -84,30 +116,33 @@ class MixtureDensityOutputLayer(object):
 
 
 class LinearLayer(object):
-    def __init__(self, rng, input, n_in, n_out, W = None, b = None):
+    def __init__(self, rng, input, n_in, n_out, W = None, b = None, target = None):
         n_in = int(n_in)  # ensure sizes have integer type
         n_out = int(n_out)# ensure sizes have integer type
 
+        if target is not None:
+            input = input.transfer(target)
+
         self.input = input
 
         # initialize with 0 the weights W as a matrix of shape (n_in, n_out)
         if W is None:
             W_value = rng.normal(0.0, 1.0/numpy.sqrt(n_in), size=(n_in, n_out))
-            W = theano.shared(value=numpy.asarray(W_value, dtype=theano.config.floatX), name='W', borrow=True)
+            W = shared_on_target(numpy.asarray(W_value, dtype=theano.config.floatX), 'W', target, borrow=True)
 
         if b is None:
-            b = theano.shared(value=numpy.zeros((n_out,),
+            b = shared_on_target(numpy.zeros((n_out,),
                                         dtype=theano.config.floatX),
-                                   name='b', borrow=True)
+                                 'b', target, borrow=True)
 
         self.W = W
         self.b = b
 
-        self.delta_W = theano.shared(value = numpy.zeros((n_in,n_out),
-                                     dtype=theano.config.floatX), name='delta_W')
+        self.delta_W = shared_on_target(numpy.zeros((n_in,n_out),
+                                        dtype=theano.config.floatX), 'delta_W', target)
 
-        self.delta_b = theano.shared(value = numpy.zeros_like(self.b.get_value(borrow=True),
-                                     dtype=theano.config.floatX), name='delta_b')
+        self.delta_b = shared_on_target(numpy.zeros_like(self.b.get_value(borrow=True),
+                                        dtype=theano.config.floatX), 'delta_b', target)
 
         self.output = T.dot(self.input, self.W) + self.b
 
@@ -181,15 +216,18 @@ class SigmoidLayer(object):
 
 class GeneralLayer(object):
 
-    def __init__(self, rng, x, n_in, n_out, W = None, b = None, activation = 'linear', p=0.0, training=0):
+    def __init__(self, rng, x, n_in, n_out, W = None, b = None, activation = 'linear', p=0.0, training=0, target=None):
         '''
-        General feed-forward layer with any activation
+        General feed-forward layer with any activation, with its parameters on the gpuarray context `target` when one is given
         '''
         logger = logging.getLogger('general_layer')
         
         n_in  = int(n_in)  # ensure sizes have integer type
         n_out = int(n_out)# ensure sizes have integer type
 
+        if target is not None:
+            x = x.transfer(target)
+
         self.x = x
 
         srng = RandomStreams(seed=123456)
@@ -205,21 +243,21 @@ class GeneralLayer(object):
         if W is None:
             W_value = numpy.asarray(rng.normal(0.0, 1.0/numpy.sqrt(n_in),
                       size=(n_in, n_out)), dtype=theano.config.floatX)
-            W = theano.shared(value=W_value,
-                              name='W', borrow=True)
+            W = shared_on_target(W_value,
+                                 'W', target, borrow=True)
         if b is None:
-            b = theano.shared(value=numpy.zeros((n_out,),
-                              dtype=theano.config.floatX),
-                              name='b', borrow=True)
+            b = shared_on_target(numpy.zeros((n_out,),
+                                 dtype=theano.config.floatX),
+                                 'b', target, borrow=True)
 
         self.W = W
         self.b = b
 
-        self.delta_W = theano.shared(value = numpy.zeros((n_in,n_out),
-                                     dtype=theano.config.floatX), name='delta_W')
+        self.delta_W = shared_on_target(numpy.zeros((n_in,n_out),
+                                        dtype=theano.config.floatX), 'delta_W', target)
 
-        self.delta_b = theano.shared(value = numpy.zeros_like(self.b.get_value(borrow=True),
-                                     dtype=theano.config.floatX), name='delta_b')
+        self.delta_b = shared_on_target(numpy.zeros_like(self.b.get_value(borrow=True),
+                                        dtype=theano.config.floatX), 'delta_b', target)
 
         self.output = T.dot(self.x, self.W) + self.b
 
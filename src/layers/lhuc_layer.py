@@ -155,10 +155,10 @@ class LstmBase_LHUC(object):
         self.c0 = theano.shared(value=np.zeros((n_h, ), dtype = theano.config.floatX), name = 'c0')
 
 
-        self.Wix = T.dot(self.input, self.W_xi)
-        self.Wfx = T.dot(self.input, self.W_xf)
-        self.Wcx = T.dot(self.input, self.W_xc)
-        self.Wox = T.dot(self.input, self.W_xo)
+        self.Wix = T.dot(self.input, self.W_xi) + self.b_i
+        self.Wfx = T.dot(self.input, self.W_xf) + self.b_f
+        self.Wcx = T.dot(self.input, self.W_xc) + self.b_c
+        self.Wox = T.dot(self.input, self.W_xo) + self.b_o
 
 
         
@@ -171,7 +171,7 @@ class LstmBase_LHUC(object):
     def recurrent_fn(self, Wix, Wfx, Wcx, Wox, h_tm1, c_tm1 = None):
         """ This implements a genetic recurrent function, called by self.__init__().
         
-        :param Wix: pre-computed matrix applying the weight matrix W on  the input units, for input gate
+        :param Wix: pre-computed matrix applying the weight matrix W on  the input units plus the bias, for input gate
         :param Wfx: Similar to Wix, but for forget gate
         :param Wcx: Similar to Wix, but for cell memory
         :param Wox: Similar to Wox, but for output gate
@@ -223,12 +223,12 @@ class VanillaLstm_LHUC(LstmBase_LHUC):
         
         """
     
-        i_t = T.nnet.sigmoid(Wix + T.dot(h_tm1, self.W_hi) + self.w_ci * c_tm1 + self.b_i)  #
-        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.w_cf * c_tm1 + self.b_f)  # 
+        i_t = T.nnet.sigmoid(Wix + T.dot(h_tm1, self.W_hi) + self.w_ci * c_tm1)  #
+        f_t = T.nnet.sigmoid(Wfx + T.dot(h_tm1, self.W_hf) + self.w_cf * c_tm1)  # 
     
-        c_t = f_t * c_tm1 + i_t * T.tanh(Wcx + T.dot(h_tm1, self.W_hc) + self.b_c)
+        c_t = f_t * c_tm1 + i_t * T.tanh(Wcx + T.dot(h_tm1, self.W_hc))
 
-        o_t = T.nnet.sigmoid(Wox + T.dot(h_tm1, self.W_ho) + self.w_co * c_t + self.b_o)
+        o_t = T.nnet.sigmoid(Wox + T.dot(h_tm1, self.W_ho) + self.w_co * c_t)
                             
         h_t = o_t * T.tanh(c_t)
 
@@ -53,24 +53,26 @@ class RecurrentOutputLayer(object):
             self.y0 = theano.shared(value=np.zeros((n_out, ), dtype = config.floatX), name = 'y0')
 
 
-        self.Wix = T.dot(self.input, self.W_xi)
+        self.Wix = T.dot(self.input, self.W_xi) + self.b_y
 
         self.y, _ = theano.scan(self.recurrent_as_activation_function, sequences = self.Wix,
-                                                                      outputs_info = self.y0)
+                                                                      outputs_info = self.y0,
+                                                                      non_sequences = self.W_yi)
 
         self.output = self.y
 
         self.params = [self.W_xi, self.W_yi, self.b_y]
 
-    def recurrent_as_activation_function(self, Wix, y_tm1):
+    def recurrent_as_activation_function(self, Wix, y_tm1, W_yi):
         """ Implement the recurrent unit as an activation function. This function is called by self.__init__().
 
-        :param Wix: it equals to W^{hx}x_{t}, as it does not relate with recurrent, pre-calculate the value for fast computation
+        :param Wix: it equals to W^{hx}x_{t}+b_{y}, as it does not relate with recurrent, pre-calculate the value for fast computation
         :type Wix: matrix
         :param y_tm1: contains the output from previous time step
         :type y_tm1: matrix, each row means an output vector of a time step
+        :param W_yi: the recurrent weight matrix, passed by scan as a non-sequence
         """
 
-        y_t = Wix + T.dot(y_tm1, self.W_yi) + self.b_y  #
+        y_t = Wix + T.dot(y_tm1, W_yi)  #
 
         return y_t
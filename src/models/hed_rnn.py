@@ -1,5 +1,12 @@
 
+import os
 import sys
+import time
+import pickle
+import hashlib
+import queue
+import threading
+from concurrent.futures import Future
 
 import numpy as np
 from collections import OrderedDict
@@ -7,9 +14,11 @@ from collections import OrderedDict
 import theano
 import theano.tensor as T
 from theano.tensor.shared_randomstreams import RandomStreams
+from theano.compile.sharedvalue import SharedVariable
 
 from layers.gating import SimplifiedLstm, SimplifiedLstmDecoder, BidirectionSLstm, VanillaLstm, VanillaLstmDecoder, BidirectionLstm, VanillaRNN, VanillaRNNDecoder, SimplifiedGRU, GatedRecurrentUnit, LstmNoPeepholes, LstmNOG, LstmNIG, LstmNFG
-from layers.layers import GeneralLayer, LinearLayer, SigmoidLayer
+from layers.gating import BidirectionBase, CuDNNRNNLayer, cudnn_rnn_available
+from layers.layers import GeneralLayer, LinearLayer, SigmoidLayer, shared_on_target, target_of, group_by_target
 from layers.recurrent_output_layer import RecurrentOutputLayer
 from layers.lhuc_layer import SigmoidLayer_LHUC, VanillaLstm_LHUC
 
@@ -20,6 +29,151 @@ from models.seq2seq import VanillaSequenceEncoder, DistributedSequenceEncoder
 
 import logging
 
+# hidden layer types which can be computed by cuDNN, with the matching (rnn_mode, direction_mode)
+CUDNN_RNN_TYPES = {'LSTM': ('lstm', 'unidirectional'), 'GRU': ('gru', 'unidirectional'), 'BLSTM': ('lstm', 'bidirectional')}
+
+# constructors of the recurrent hidden layer types, (rng, x, n_in, n_h, ...)
+RECURRENT_LAYERS = {'SLSTM': SimplifiedLstm, 'SLSTME': SimplifiedLstm,
+                    'SGRU': SimplifiedGRU,
+                    'GRU': GatedRecurrentUnit,
+                    'LSTM': VanillaLstm, 'LSTME': VanillaLstm,
+                    'RNN': VanillaRNN, 'RNNE': VanillaRNN}
+
+# constructors of the bidirectional hidden layer types, (rng, x, n_in, n_h, n_out, ...)
+BIDIRECTIONAL_LAYERS = {'BSLSTM': BidirectionSLstm, 'BSLSTME': BidirectionSLstm,
+                        'BLSTM': BidirectionLstm, 'BLSTME': BidirectionLstm}
+
+# constructors of the decoder hidden layer types, which also compute the output features, (rng, x, n_in, n_h, n_out, ...)
+DECODER_LAYERS = {'SLSTMD': SimplifiedLstmDecoder,
+                  'LSTMD': VanillaLstmDecoder,
+                  'RNND': VanillaRNNDecoder}
+
+# hidden layer types computed by a feedforward activation, and the variants with a special role in the network
+LIST_OF_ACTIVATIONS = frozenset(['TANH', 'SIGMOID', 'SOFTMAX', 'RELU', 'RESU'])
+
+BLSTM_VARIANTS   = frozenset(['BLSTM', 'BSLSTM', 'BLSTME', 'BSLSTME'])
+ENCODER_VARIANTS = frozenset(['RNNE', 'LSTME', 'BLSTME', 'SLSTME', 'TANHE'])
+DECODER_VARIANTS = frozenset(['RNND', 'LSTMD', 'SLSTMD'])
+
+# recurrent hidden layer types which cannot reset their states between packed utterances
+PACKED_UNSUPPORTED_LAYERS = frozenset(list(DECODER_LAYERS) + ['LSTM_LHUC'])
+
+# hidden layer types whose parameters are always created on the default device
+UNPLACED_LAYERS = frozenset(['TANH_LHUC', 'LSTM_LHUC'])
+
+def lift_shared_variables(outputs, givens):
+    """ This function rewrites the graph of a function without updates so that its shared variables become plain inputs
+
+    The givens are applied first, and the default updates of the shared variables (the random states of dropout) are
+    added as extra outputs, as theano.function adds them to the updates.
+
+    :returns: the rewritten outputs and default update values, the updated and all the shared variables, and the inputs standing in for them
+    """
+
+    updated = []
+    graph_outputs = list(outputs)
+
+    for variable in theano.gof.graph.inputs(outputs):
+        if isinstance(variable, SharedVariable) and hasattr(variable, 'default_update') and variable not in updated:
+            updated.append(variable)
+            graph_outputs.append(variable.default_update)
+
+    graph_outputs = theano.clone(graph_outputs, replace=givens)
+
+    shared_variables = []
+    for variable in theano.gof.graph.inputs(graph_outputs) + updated:
+        if isinstance(variable, SharedVariable) and variable not in shared_variables:
+            shared_variables.append(variable)
+
+    stand_ins = [variable.type(name=variable.name) for variable in shared_variables]
+    graph_outputs = theano.clone(graph_outputs, replace=OrderedDict(zip(shared_variables, stand_ins)))
+
+    return graph_outputs[:len(outputs)], graph_outputs[len(outputs):], updated, shared_variables, stand_ins
+
+def constant_signature(variable):
+    """ This function returns a description of a constant of a theano graph, with a hash of the whole of its data
+    """
+
+    variable_type, data = variable.signature()
+    if isinstance(data, (np.ndarray, np.number, int, float)):
+        data = np.ascontiguousarray(data)
+        return 'constant %s %s %s %s' %(variable_type, data.dtype, data.shape, hashlib.md5(data.tobytes()).hexdigest())
+
+    return 'constant %s %r' %(variable_type, data)
+
+def graph_structure(inputs, outputs):
+    """ This function describes a theano graph as a list of lines, one for each operation, its inputs, given by the
+    position in inputs or the index of the operation and of the output computing them, and the types of its outputs.
+    The inner graphs of scan loops are described in the same way.
+    """
+
+    sources = OrderedDict((variable, 'input %d' %(k)) for k, variable in enumerate(inputs))
+
+    def source(variable):
+        if variable in sources:
+            return sources[variable]
+        if isinstance(variable, theano.gof.Constant):
+            return constant_signature(variable)
+        return 'orphan %s' %(variable.type)
+
+    structure = []
+    for n, node in enumerate(theano.gof.graph.io_toposort(inputs, outputs)):
+        structure.append(str(node.op))
+        if isinstance(getattr(node.op, 'info', None), dict) and hasattr(node.op, 'inputs') and hasattr(node.op, 'outputs'):
+            structure.extend(str(item) for item in sorted(node.op.info.items())
+                             if isinstance(item[1], (int, str, list, tuple, dict, type(None))))
+            structure.extend(graph_structure(node.op.inputs, node.op.outputs))
+        structure.extend(source(variable) for variable in node.inputs)
+        for k, variable in enumerate(node.outputs):
+            sources[variable] = 'node %d output %d' %(n, k)
+            structure.append(str(variable.type))
+
+    structure.extend('output %s' %(source(variable)) for variable in outputs)
+
+    return structure
+
+def graph_signature(inputs, outputs):
+    """ This function returns a hash of the structure of a theano graph without shared variables
+
+    The hash covers the operations and how they are connected, the types and the data of the constants of the graph,
+    see :func:`graph_structure`, so that a compiled function can be reused by any network with the same graph.
+    """
+
+    graph_inputs = [getattr(variable, 'variable', variable) for variable in inputs]
+
+    signature = [theano.__version__, theano.config.device, theano.config.floatX, theano.config.mode, theano.config.optimizer]
+    signature.extend(str(variable.type) for variable in graph_inputs)
+    signature.extend(graph_structure(graph_inputs, outputs))
+
+    return hashlib.md5('\n'.join(signature).encode('utf-8')).hexdigest()
+
+class CachedFunction(object):
+    """ This class calls a compiled theano function whose shared variables were lifted to inputs, see :func:`lift_shared_variables`
+
+    The current values of the shared variables are passed after the arguments, and the default update values returned
+    after the outputs are stored back, so that the function behaves as the theano function of the original graph.
+    """
+
+    def __init__(self, function, shared_variables, updated, n_outputs, single_output):
+
+        self.function = function
+        self.shared_variables = shared_variables
+        self.updated = updated
+        self.n_outputs = n_outputs
+        self.single_output = single_output
+
+    def __call__(self, *args):
+
+        values = [variable.get_value(borrow=True, return_internal_type=True) for variable in self.shared_variables]
+        outputs = self.function(*(list(args) + values))
+
+        for variable, value in zip(self.updated, outputs[self.n_outputs:]):
+            variable.set_value(value, borrow=True)
+
+        outputs = outputs[:self.n_outputs]
+
+        return outputs[0] if self.single_output else outputs
+
 class DeepEncoderDecoderNetwork(object):
     """
     This class is to assemble various neural network architectures. From basic feedforward neural network to bidirectional gated recurrent neural networks and hybrid architecture. **Hybrid** means a combination of feedforward and recurrent architecture.
@@ -27,7 +181,7 @@ class DeepEncoderDecoderNetwork(object):
     """
 
 
-    def __init__(self, n_in, hidden_layer_size, n_out, L1_reg, L2_reg, hidden_layer_type, output_type='LINEAR', network_type='S2S', ed_type='HED', dropout_rate=0.0, optimizer='sgd', MLU_div_lengths = [], loss_function='MMSE', rnn_batch_training=False):
+    def __init__(self, n_in, hidden_layer_size, n_out, L1_reg, L2_reg, hidden_layer_type, output_type='LINEAR', network_type='S2S', ed_type='HED', dropout_rate=0.0, optimizer='sgd', MLU_div_lengths = [], loss_function='MMSE', rnn_batch_training=False, cudnn_rnn=False, bidirectional_contexts=None, fp16_inference=False, device_map=None, function_cache_dir=None, packed_training=False, inference_only=False):
         """ This function initialises a neural network
 
         :param n_in: Dimensionality of input features
@@ -41,8 +195,18 @@ class DeepEncoderDecoderNetwork(object):
         :param L2_reg: the L2 regulasation weight
         :param output_type: the activation type of the output layer, by default is 'LINEAR', linear regression.
         :param dropout_rate: probability of dropout, a float number between 0 and 1.
+        :param cudnn_rnn: compute LSTM, GRU and BLSTM layers with cuDNN when theano runs on a CUDA device. The cuDNN LSTM has no peephole connections.
+        :param bidirectional_contexts: a pair of gpuarray context names, e.g. ('dev0', 'dev1') declared in theano's `contexts` flag, on which the forward and backward directions of BLSTM and BSLSTM layers are computed concurrently.
+        :param fp16_inference: predict with a float16 copy of the network. Training and the stored parameters stay in theano's floatX.
+        :param device_map: the gpuarray context name of each hidden layer, e.g. ['dev0', 'dev0', 'dev1', 'dev1'], to partition the network across several GPUs, None for a layer on the default device. The output layer is placed with the last hidden layer. The LHUC layers, the layers computed by cuDNN and the recurrent output layer cannot be placed, and the directions of a bidirectional layer are placed together unless bidirectional_contexts is given.
+        :param function_cache_dir: a directory to store the compiled prediction and validation functions in, so that later processes building the same network skip their compilation. The training functions are compiled in every process, see :func:`compile_function`.
+        :param packed_training: train on the utterances of a mini-batch concatenated in the frames of a matrix, without padding. The ends of the utterances are given with the training data, see :func:`build_finetune_functions`, and the states of the recurrent layers are reset at the start of each utterance. The data providers and run_merlin.py do not pack the data, the caller builds the packed batches.
+        :param inference_only: build the network for prediction only, without the momentum and the LHUC parameter list of training, as the float16 copy of :func:`inference_network`.
         """
 
+        # the arguments of the network, to build a float16 copy of it for inference
+        self.init_kwargs = {name: value for name, value in locals().items() if name != 'self'}
+
         logger = logging.getLogger("merlin.DNN initialization")
 
         self.n_in = int(n_in)
@@ -55,14 +219,40 @@ class DeepEncoderDecoderNetwork(object):
         self.loss_function = loss_function
         self.is_train = T.iscalar('is_train')
         self.rnn_batch_training = rnn_batch_training
+        self.packed_training = packed_training
 
-        assert len(hidden_layer_size) == len(hidden_layer_type)
+        self.cudnn_rnn = cudnn_rnn and cudnn_rnn_available()
+        if cudnn_rnn and not self.cudnn_rnn:
+            logger.warning("cuDNN is not available on device %s, using the theano.scan implementation of recurrent layers" %(theano.config.device))
 
-        self.list_of_activations = ['TANH', 'SIGMOID', 'SOFTMAX', 'RELU', 'RESU']
-        
-        BLSTM_variants   = ['BLSTM', 'BSLSTM', 'BLSTME', 'BSLSTME']
-        Encoder_variants = ['RNNE', 'LSTME', 'BLSTME', 'SLSTME', 'TANHE']
-        Decoder_variants = ['RNND', 'LSTMD', 'SLSTMD']
+        self.bidirectional_contexts = bidirectional_contexts
+        self.fp16_inference = fp16_inference
+
+        if device_map is None:
+            device_map = [None] * len(hidden_layer_size)
+        if len(device_map) != len(hidden_layer_size):
+            logger.critical("The device_map has %d devices for %d hidden layers\n" %(len(device_map), len(hidden_layer_size)))
+            sys.exit(1)
+
+        # the placement is checked before any layer is built
+        for layer_type, target in zip(hidden_layer_type, device_map):
+            if target is None:
+                continue
+            if layer_type in UNPLACED_LAYERS or (self.cudnn_rnn and not packed_training and layer_type in CUDNN_RNN_TYPES):
+                logger.critical("This hidden layer type: %s cannot be placed on device %s, set its device_map entry to None\n" %(layer_type, target))
+                sys.exit(1)
+            if layer_type in BLSTM_VARIANTS and bidirectional_contexts is not None:
+                logger.critical("The directions of the %s layers are placed by bidirectional_contexts, set their device_map entry to None instead of %s\n" %(layer_type, target))
+                sys.exit(1)
+        if output_type.lower() == 'recurrent' and device_map[-1] is not None:
+            logger.critical("The recurrent output layer cannot be placed on device %s, set the last device_map entry to None\n" %(device_map[-1]))
+            sys.exit(1)
+
+        self.device_map = device_map
+
+        self.function_cache_dir = function_cache_dir
+
+        assert len(hidden_layer_size) == len(hidden_layer_type)
 
         if self.rnn_batch_training:
             self.x = T.tensor3('x')
@@ -75,6 +265,24 @@ class DeepEncoderDecoderNetwork(object):
             self.d = T.ivector('d')
             self.f = T.matrix('f')
 
+        recurrent_kwargs = dict(p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
+        bidirectional_kwargs = dict(recurrent_kwargs)
+
+        if self.packed_training:
+            if self.rnn_batch_training or network_type != "RNN" or output_type.lower() == 'recurrent':
+                logger.critical("packed_training concatenates the utterances in the frames of a matrix, it cannot be used with rnn_batch_training, a recurrent output layer or the %s network type\n" %(network_type))
+                sys.exit(1)
+
+            # the end of each utterance in the frames of self.x, the states are reset after each end but the last one, i.e.
+            # at the first frame of the next utterance, and for the backward directions at the last frame of the utterance
+            self.seg_ends = T.ivector('seg_ends')
+            no_reset = T.zeros_like(self.x[:, 0])
+            fwd_reset = T.set_subtensor(no_reset[self.seg_ends[:-1]], 1)
+            bwd_reset = T.set_subtensor(no_reset[self.seg_ends[:-1] - 1], 1)[::-1]
+
+            recurrent_kwargs['reset'] = fwd_reset
+            bidirectional_kwargs['resets'] = (fwd_reset, bwd_reset)
+
         self.L1_reg = L1_reg
         self.L2_reg = L2_reg
 
@@ -84,7 +292,17 @@ class DeepEncoderDecoderNetwork(object):
 
         rng = np.random.RandomState(123)
 
-        prev_seg_end = 0
+        # the hierarchical encoder-decoder reads the durations of all the levels from self.d, one level after the other.
+        # The table of the offsets of each level in self.d, and of the number of steps each level expands to, is built
+        # once here, as every hidden layer keeps the number of steps of its input
+        encoder_positions = [i for i in range(self.n_layers) if hidden_layer_type[i-1] in ENCODER_VARIANTS]
+        seg_offsets = [0]
+        seg_lengths = [self.x.shape[0]]
+        if ed_type == "HED":
+            for _ in encoder_positions:
+                seg_offsets.append(seg_offsets[-1] + seg_lengths[-1])
+                seg_lengths.append(T.sum(self.d[seg_offsets[-2]:seg_offsets[-1]]))
+
         encoder_count = 0
         MLU_div = MLU_div_lengths
         for i in range(self.n_layers):
@@ -92,7 +310,7 @@ class DeepEncoderDecoderNetwork(object):
                 input_size = n_in
             else:
                 input_size = hidden_layer_size[i-1]
-                if hidden_layer_type[i-1] in BLSTM_variants:
+                if hidden_layer_type[i-1] in BLSTM_VARIANTS:
                     input_size = hidden_layer_size[i-1]*2
 
             if i == 0:
@@ -101,7 +319,7 @@ class DeepEncoderDecoderNetwork(object):
                 layer_input = self.rnn_layers[i-1].output
             
             ### sequence-to-sequence mapping ###
-            if hidden_layer_type[i-1] in Encoder_variants:
+            if i in encoder_positions:
                 dur_input        = self.d
                 frame_feat_input = self.f
 
@@ -112,45 +330,38 @@ class DeepEncoderDecoderNetwork(object):
                     input_size    = input_size+4
                 # hierarchical encoder-decoder
                 elif ed_type == "HED":
-                    seg_len       = layer_input.size//input_size
-                    seg_dur_input = dur_input[prev_seg_end: prev_seg_end+seg_len]
-                    num_of_segs   = T.sum(seg_dur_input)
+                    seg_dur_input = dur_input[seg_offsets[encoder_count]:seg_offsets[encoder_count+1]]
+                    num_of_segs   = seg_lengths[encoder_count+1]
                     seq2seq_model = DistributedSequenceEncoder(rng, layer_input, seg_dur_input)
                     addfeat_input = frame_feat_input[0:num_of_segs, MLU_div[encoder_count]:MLU_div[encoder_count+1]]  
                     layer_input   = T.concatenate((seq2seq_model.encoded_output, addfeat_input), axis=1)
                     input_size    = input_size + (MLU_div[encoder_count+1]-MLU_div[encoder_count])
-                    prev_seg_end  = prev_seg_end + seg_len
                     encoder_count = encoder_count + 1
 
             # hidden layer activation
-            if hidden_layer_type[i] in self.list_of_activations:
+            if self.packed_training and hidden_layer_type[i] in PACKED_UNSUPPORTED_LAYERS:
+                logger.critical("This hidden layer type: %s does not support packed_training\n" %(hidden_layer_type[i]))
+                sys.exit(1)
+
+            if self.cudnn_rnn and not self.packed_training and hidden_layer_type[i] in CUDNN_RNN_TYPES:
+                rnn_mode, direction_mode = CUDNN_RNN_TYPES[hidden_layer_type[i]]
+                hidden_layer = CuDNNRNNLayer(rng, layer_input, input_size, hidden_layer_size[i], rnn_mode, direction_mode, p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
+            elif hidden_layer_type[i] in RECURRENT_LAYERS:
+                hidden_layer = RECURRENT_LAYERS[hidden_layer_type[i]](rng, layer_input, input_size, hidden_layer_size[i], target=device_map[i], **recurrent_kwargs)
+            elif hidden_layer_type[i] in BIDIRECTIONAL_LAYERS:
+                # both directions stay on the device of the layer unless they have their own contexts
+                targets = self.bidirectional_contexts or (device_map[i], device_map[i])
+                hidden_layer = BIDIRECTIONAL_LAYERS[hidden_layer_type[i]](rng, layer_input, input_size, hidden_layer_size[i], hidden_layer_size[i], targets=targets, **bidirectional_kwargs)
+            elif hidden_layer_type[i] in DECODER_LAYERS:
+                hidden_layer = DECODER_LAYERS[hidden_layer_type[i]](rng, layer_input, input_size, hidden_layer_size[i], self.n_out, target=device_map[i], **recurrent_kwargs)
+            elif hidden_layer_type[i] in LIST_OF_ACTIVATIONS:
                 hidden_activation = hidden_layer_type[i].lower()
-                hidden_layer = GeneralLayer(rng, layer_input, input_size, hidden_layer_size[i], activation=hidden_activation, p=self.dropout_rate, training=self.is_train)
+                hidden_layer = GeneralLayer(rng, layer_input, input_size, hidden_layer_size[i], activation=hidden_activation, p=self.dropout_rate, training=self.is_train, target=device_map[i])
             elif hidden_layer_type[i] == 'TANHE' or hidden_layer_type[i] == 'SIGMOIDE':
                 hidden_activation = hidden_layer_type[i][0:-1].lower()
-                hidden_layer = GeneralLayer(rng, layer_input, input_size, hidden_layer_size[i], activation=hidden_activation, p=self.dropout_rate, training=self.is_train)
+                hidden_layer = GeneralLayer(rng, layer_input, input_size, hidden_layer_size[i], activation=hidden_activation, p=self.dropout_rate, training=self.is_train, target=device_map[i])
             elif hidden_layer_type[i] == 'TANH_LHUC':
                 hidden_layer = SigmoidLayer_LHUC(rng, layer_input, input_size, hidden_layer_size[i], activation=T.tanh, p=self.dropout_rate, training=self.is_train)
-            elif hidden_layer_type[i] == 'SLSTM' or hidden_layer_type[i] == 'SLSTME':
-                hidden_layer = SimplifiedLstm(rng, layer_input, input_size, hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'SLSTMD':
-                hidden_layer = SimplifiedLstmDecoder(rng, layer_input, input_size, hidden_layer_size[i], self.n_out, p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'SGRU':
-                hidden_layer = SimplifiedGRU(rng, layer_input, input_size, hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'GRU':
-                hidden_layer = GatedRecurrentUnit(rng, layer_input, input_size, hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'LSTM' or hidden_layer_type[i] == 'LSTME':
-                hidden_layer = VanillaLstm(rng, layer_input, input_size, hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'LSTMD':
-                hidden_layer = VanillaLstmDecoder(rng, layer_input, input_size, hidden_layer_size[i], self.n_out, p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'BSLSTM' or hidden_layer_type[i] == 'BSLSTME':
-                hidden_layer = BidirectionSLstm(rng, layer_input, input_size, hidden_layer_size[i], hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'BLSTM' or hidden_layer_type[i] == 'BLSTME':
-                hidden_layer = BidirectionLstm(rng, layer_input, input_size, hidden_layer_size[i], hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'RNN' or hidden_layer_type[i] == 'RNNE':
-                hidden_layer = VanillaRNN(rng, layer_input, input_size, hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
-            elif hidden_layer_type[i] == 'RNND':
-                hidden_layer = VanillaRNNDecoder(rng, layer_input, input_size, hidden_layer_size[i], self.n_out, p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
             elif hidden_layer_type[i] == 'LSTM_LHUC':
                 hidden_layer = VanillaLstm_LHUC(rng, layer_input, input_size, hidden_layer_size[i], p=self.dropout_rate, training=self.is_train, rnn_batch_training=self.rnn_batch_training)
             else:
@@ -161,29 +372,30 @@ class DeepEncoderDecoderNetwork(object):
             self.params.extend(hidden_layer.params)
 
         input_size = hidden_layer_size[-1]
-        if hidden_layer_type[-1] in BLSTM_variants:
+        if hidden_layer_type[-1] in BLSTM_VARIANTS:
             input_size = hidden_layer_size[-1]*2
 
-        if hidden_layer_type[-1] in Decoder_variants:
+        if hidden_layer_type[-1] in DECODER_VARIANTS:
             self.final_layer = self.rnn_layers[-1]
         else:
             output_activation = output_type.lower()
             if output_activation == 'linear':
-                self.final_layer = LinearLayer(rng, self.rnn_layers[-1].output, input_size, self.n_out)
+                self.final_layer = LinearLayer(rng, self.rnn_layers[-1].output, input_size, self.n_out, target=device_map[-1])
             elif output_activation == 'recurrent':
                 self.final_layer = RecurrentOutputLayer(rng, self.rnn_layers[-1].output, input_size, self.n_out, rnn_batch_training=self.rnn_batch_training)
-            elif output_type.upper() in self.list_of_activations:
-                self.final_layer = GeneralLayer(rng, self.rnn_layers[-1].output, input_size, self.n_out, activation=output_activation)
+            elif output_type.upper() in LIST_OF_ACTIVATIONS:
+                self.final_layer = GeneralLayer(rng, self.rnn_layers[-1].output, input_size, self.n_out, activation=output_activation, target=device_map[-1])
             else:
                 logger.critical("This output layer type: %s is not supported right now! \n Please use one of the following: LINEAR, BSLSTM\n" %(output_type))
                 sys.exit(1)
 
             self.params.extend(self.final_layer.params)
 
-        self.updates = {}
-        for param in self.params:
-            self.updates[param] = theano.shared(value = np.zeros(param.get_value(borrow = True).shape,
-                                                dtype = theano.config.floatX), name = 'updates')
+        if not inference_only:
+            # In lhuc the parameters are only scaling parameters which have the name 'c'
+            self.lhuc_params = [p for p in self.params if p.name == 'c']
+
+            self.init_flat_updates()
 
         if self.loss_function == 'CCE':
             self.finetune_cost = self.categorical_crossentropy_loss(self.final_layer.output, self.y) 
@@ -196,17 +408,103 @@ class DeepEncoderDecoderNetwork(object):
                 self.y_mod = T.reshape(self.y, (-1, n_out))
                 self.final_layer_output = T.reshape(self.final_layer.output, (-1, n_out))
 
-                nonzero_rows = T.any(self.y_mod, 1).nonzero()
-            
-                self.y_mod = self.y_mod[nonzero_rows]
-                self.final_layer_output = self.final_layer_output[nonzero_rows]
-            
-                self.finetune_cost = T.mean(T.sum((self.final_layer_output - self.y_mod) ** 2, axis=1))
-                self.errors = T.mean(T.sum((self.final_layer_output - self.y_mod) ** 2, axis=1))
+                # padded frames have all-zero targets, they are masked out instead of gathering the nonzero rows
+                mask = T.cast(T.any(self.y_mod, axis=1), theano.config.floatX)
+
+                sse = T.sum(T.sum((self.final_layer_output - self.y_mod) ** 2, axis=1) * mask)
+
+                self.finetune_cost = sse / T.maximum(T.sum(mask), 1)
+                self.errors = self.finetune_cost
             else:
                 self.finetune_cost = T.mean(T.sum((self.final_layer.output - self.y) ** 2, axis=1))
                 self.errors = T.mean(T.sum((self.final_layer.output - self.y) ** 2, axis=1))
 
+    def init_flat_updates(self):
+        """ This function is to allocate the momentum of the parameters as a flat vector on each device the parameters are placed on, see :func:`flat_sgd_updates`
+        """
+
+        # the shapes are read from the internal storage, without copying the parameters from the device
+        self.param_shapes = [param.get_value(borrow = True, return_internal_type = True).shape for param in self.params]
+        self.param_sizes  = [int(np.prod(shape)) for shape in self.param_shapes]
+
+        # the indices in self.params of the parameters of each device, and the flat momentum of each device
+        self.param_groups = group_by_target(self.params)
+        self.flat_updates = OrderedDict()
+
+        # the momentum of each parameter, as a view of the flat vector of its device
+        self.updates = OrderedDict()
+        for target, indices in self.param_groups.items():
+            flat_updates = shared_on_target(np.zeros((sum(self.param_sizes[k] for k in indices), ), dtype = theano.config.floatX), 'updates', target)
+            self.flat_updates[target] = flat_updates
+
+            offset = 0
+            for k in indices:
+                self.updates[self.params[k]] = T.reshape(flat_updates[offset:offset+self.param_sizes[k]], self.param_shapes[k])
+                offset += self.param_sizes[k]
+
+    def flat_sgd_updates(self, params, gparams, lr, mom, lr_scales=None):
+        """ This function is to compute the momentum SGD updates, with one update of the flat momentum of each device
+
+        Only the gradients and the momentum of the trained parameters are computed: when some parameters are not trained,
+        e.g. frozen layers or LHUC adaptation, the momentum is updated over the contiguous runs of trained parameters.
+
+        :param params: the parameters to train, in the order of self.params, the frozen parameters are left out
+        :param gparams: the gradients of params
+        :param lr_scales: a multiplier of the learning rate for each parameter in params, by default 1
+        :returns: an OrderedDict of updates
+
+        """
+
+        # models pickled before the momentum was flattened for each device
+        if not hasattr(self, 'param_groups'):
+            self.init_flat_updates()
+
+        if lr_scales is None:
+            lr_scales = [1] * len(params)
+
+        grads = {}
+        for param, gparam, scale in zip(params, gparams, lr_scales):
+            grads[param] = gparam if scale == 1 else scale * gparam
+
+        updates = OrderedDict()
+
+        for target, indices in self.param_groups.items():
+            # the runs of consecutive trained parameters, as [start, stop, indices] in the flat momentum of the device
+            runs = []
+            offset = 0
+            for k in indices:
+                if self.params[k] in grads:
+                    if runs and runs[-1][1] == offset:
+                        runs[-1][1] += self.param_sizes[k]
+                        runs[-1][2].append(k)
+                    else:
+                        runs.append([offset, offset + self.param_sizes[k], [k]])
+                offset += self.param_sizes[k]
+
+            flat_updates = self.flat_updates[target]
+            new_updates = flat_updates
+
+            for start, stop, run in runs:
+                flat_g = T.concatenate([T.flatten(grads[self.params[k]]) for k in run])
+
+                if stop - start == offset:
+                    upd = mom * flat_updates - lr * flat_g
+                    new_updates = upd
+                else:
+                    upd = mom * flat_updates[start:stop] - lr * flat_g
+                    new_updates = T.set_subtensor(new_updates[start:stop], upd)
+
+                position = 0
+                for k in run:
+                    param = self.params[k]
+                    updates[param] = param + T.reshape(upd[position:position+self.param_sizes[k]], self.param_shapes[k])
+                    position += self.param_sizes[k]
+
+            if runs:
+                updates[flat_updates] = new_updates
+
+        return updates
+
     def categorical_crossentropy_loss(self, predictions, targets):
         return T.nnet.categorical_crossentropy(predictions, targets).mean()
 
@@ -223,83 +521,207 @@ class DeepEncoderDecoderNetwork(object):
         return T.nnet.relu(rest - corrects + delta).mean()
 
 
-    def build_finetune_functions(self, train_shared_xy, valid_shared_xy, use_lhuc=False, layer_index=0):
+    def build_finetune_functions(self, train_shared_xy, valid_shared_xy, use_lhuc=False, layer_index=0, tbptt_len=0, n_streams=1, t_overlap=0):
         """ This function is to build finetune functions and to update gradients
 
         :param train_shared_xy: theano shared variable for input and output training data
         :type train_shared_xy: tuple of shared variable
         :param valid_shared_xy: theano shared variable for input and output development data
         :type valid_shared_xy: tuple of shared variable
+        :param tbptt_len: length of the chunks for truncated back-propagation through time, 0 to back-propagate through the whole training data
+        :param n_streams: number of parallel streams the training frames are split into for truncated BPTT, i.e. the mini-batch size
+        :param t_overlap: number of frames shared by two consecutive chunks of a stream, which the later chunk back-propagates through as warm-up context but leaves out of its loss, so that each frame is counted once
         :returns: finetune functions for training and development
 
+        For a network built with packed_training, the training and development data are triples (x, y, seg_ends), where the
+        utterances are concatenated in the frames of x and y, and seg_ends is an int32 shared vector of the frame after the
+        end of each utterance, e.g. [250, 430, 812] for three utterances in 812 frames. The caller packs the batches itself, e.g.
+        with np.concatenate of the utterance matrices and np.cumsum of their lengths, as no data provider produces these triples.
+
+        With truncated BPTT the training data are matrices of concatenated frames, the training function takes the chunk index as
+        the first argument, train_model(index, lr, mom), and the hidden states of the recurrent layers are carried from one chunk
+        to the next, see :func:`get_tbptt_num_chunks` and :func:`reset_tbptt_state`.
         """
 
         logger = logging.getLogger("merlin.DNN initialization")
 
-        (train_set_x, train_set_y) = train_shared_xy
-        (valid_set_x, valid_set_y) = valid_shared_xy
+        (train_set_x, train_set_y) = train_shared_xy[:2]
+        (valid_set_x, valid_set_y) = valid_shared_xy[:2]
+
+        train_givens = {}
+        valid_givens = {}
+        if getattr(self, 'packed_training', False):
+            train_givens[self.seg_ends] = train_shared_xy[2]
+            valid_givens[self.seg_ends] = valid_shared_xy[2]
 
         lr = T.scalar('lr', dtype = theano.config.floatX)
         mom = T.scalar('mom', dtype = theano.config.floatX)  # momentum
 
-        cost = self.finetune_cost #+ self.L2_reg * self.L2_sqr
-        
-        ## added for LHUC
-        if use_lhuc:
-            # In lhuc the parameters are only scaling parameters which have the name 'c'
-            self.lhuc_params = []
-            for p in self.params:
-                if p.name == 'c':
-                    self.lhuc_params.append(p)
-            params = self.lhuc_params
-            gparams = T.grad(cost, params)
-        else:
-            params = self.params
-            gparams = T.grad(cost, params)
-
-
-        freeze_params = 0
-        for layer in range(layer_index):
-            freeze_params += len(self.rnn_layers[layer].params)
+        params, gparams = self.get_finetune_gradients(use_lhuc, layer_index)
 
         # use optimizer
         if self.optimizer=='sgd':
-            # zip just concatenate two lists
-            updates = OrderedDict()
-
-            for i, (param, gparam) in enumerate(zip(params, gparams)):
-                weight_update = self.updates[param]
-                upd = mom * weight_update - lr * gparam
-                updates[weight_update] = upd
-
-                # freeze layers and update weights
-                if i >= freeze_params:
-                    updates[param] = param + upd
+            # the frozen layers have no gradients, their weights are kept
+            updates = self.flat_sgd_updates(params, gparams, lr, mom)
 
         elif self.optimizer=='adam':
-            updates = compile_ADAM_train_function(self, gparams, learning_rate=lr)
+            updates = compile_ADAM_train_function(self, gparams, learning_rate=lr, params=params)
         elif self.optimizer=='rprop':
-            updates = compile_RPROP_train_function(self, gparams)
+            # rprop pairs the gradients with the parameters by their index in self.params
+            gradients = dict(zip(params, gparams))
+            updates = compile_RPROP_train_function(self, [gradients.get(p) for p in self.params],
+                                                   params_to_update=[i for i, p in enumerate(self.params) if p in gradients])
         else: 
             logger.critical("This optimizer: %s is not supported right now! \n Please use one of the following: sgd, adam, rprop\n" %(self.optimizer))
             sys.exit(1)
 
-        train_model = theano.function(inputs = [lr, mom],  #index, batch_size
-                                      outputs = self.errors,
-                                      updates = updates,
-                                      givens = {self.x: train_set_x, #[index*batch_size:(index + 1)*batch_size]
-                                                self.y: train_set_y,
-                                                self.is_train: np.cast['int32'](1)}, on_unused_input='ignore')
+        if tbptt_len > 0:
+            if not self.rnn_batch_training:
+                logger.critical("Truncated BPTT needs a network built with rnn_batch_training=True\n")
+                sys.exit(1)
 
+            train_model = self.build_tbptt_train_function(train_set_x, train_set_y, lr, mom, updates, tbptt_len, n_streams, t_overlap)
 
-        valid_model = theano.function(inputs = [],
+            # the development data are evaluated as a single stream
+            valid_set_x = valid_set_x.dimshuffle(0, 'x', 1)
+            valid_set_y = valid_set_y.dimshuffle(0, 'x', 1)
+        else:
+            train_givens.update({self.x: train_set_x, #[index*batch_size:(index + 1)*batch_size]
+                                 self.y: train_set_y,
+                                 self.is_train: np.cast['int32'](1)})
+            train_model = self.compile_function(inputs = [lr, mom],  #index, batch_size
+                                          outputs = self.errors,
+                                          updates = updates,
+                                          givens = train_givens, on_unused_input='ignore')
+
+
+        valid_givens.update({self.x: valid_set_x,
+                             self.y: valid_set_y,
+                             self.is_train: np.cast['int32'](0)})
+        valid_model = self.compile_function(inputs = [],
                                       outputs = self.errors,
-                                      givens = {self.x: valid_set_x,
-                                                self.y: valid_set_y,
-                                                self.is_train: np.cast['int32'](0)}, on_unused_input='ignore')
+                                      givens = valid_givens, on_unused_input='ignore')
 
         return  train_model, valid_model
 
+    def get_finetune_gradients(self, use_lhuc=False, layer_index=0):
+        """ This function returns the parameters to train and the gradients of the finetune cost for them, which are built
+        once for each (use_lhuc, layer_index), optimizer and finetune cost, and reused by the following calls, e.g. when adapting to several speakers
+
+        :param use_lhuc: train only the LHUC scaling parameters, see self.lhuc_params
+        :param layer_index: with the sgd optimizer, the parameters of the first layer_index layers are frozen and their
+                            gradients are left out of the graph
+        :returns: the list of parameters and the list of their gradients
+        """
+
+        # models pickled before the gradients were cached
+        if not hasattr(self, 'finetune_gradients'):
+            self.finetune_gradients = {}
+        if not hasattr(self, 'lhuc_params'):
+            self.lhuc_params = [p for p in self.params if p.name == 'c']
+
+        # the frozen layers depend on the optimizer, and the gradients on the cost the network currently trains
+        key = (use_lhuc, layer_index, self.optimizer, self.finetune_cost)
+        if key not in self.finetune_gradients:
+            params = self.lhuc_params if use_lhuc else self.params
+
+            if self.optimizer == 'sgd':
+                frozen = set()
+                for layer in self.rnn_layers[:layer_index]:
+                    frozen.update(layer.params)
+                params = [p for p in params if p not in frozen]
+
+            gparams = T.grad(self.finetune_cost, params)
+            self.finetune_gradients[key] = (params, gparams)
+
+        return self.finetune_gradients[key]
+
+    def build_tbptt_train_function(self, train_set_x, train_set_y, lr, mom, updates, tbptt_len, n_streams, t_overlap):
+        """ This function is to build the training function for truncated back-propagation through time
+
+        The frames of the training data are split into n_streams contiguous streams, which are processed in parallel
+        in chunks of tbptt_len frames, i.e. as a (tbptt_len, n_streams, n_in) batch. The states of the recurrent layers
+        at the frame where the next chunk starts are kept in shared variables, so that the next chunk resumes from them.
+        The states of bidirectional layers are not carried over. The cuDNN and decoder layers, whose states cannot be carried,
+        are rejected. The carried states are kept on the device of their layer.
+        After the first chunk, the first t_overlap frames of a chunk were already counted in the loss of the previous one, and their
+        targets are zeroed so that the MMSE loss masks them out as it does with the padded frames.
+
+        """
+
+        logger = logging.getLogger("merlin.DNN initialization")
+
+        if t_overlap > 0 and self.loss_function != 'MMSE':
+            logger.critical("Truncated BPTT with overlapping chunks needs the MMSE loss, which masks out the overlapping frames, not %s\n" %(self.loss_function))
+            sys.exit(1)
+
+        self.tbptt_len  = tbptt_len
+        self.n_streams  = n_streams
+        self.t_overlap  = t_overlap
+        step = tbptt_len - t_overlap
+
+        index = T.lscalar('index')
+
+        # (n_frames, n_in) -> (stream_len, n_streams, n_in)
+        stream_len = train_set_x.shape[0] // n_streams
+        stream_x = T.reshape(train_set_x[:stream_len*n_streams], (n_streams, stream_len, -1)).dimshuffle(1, 0, 2)
+        stream_y = T.reshape(train_set_y[:stream_len*n_streams], (n_streams, stream_len, -1)).dimshuffle(1, 0, 2)
+
+        # the warm-up frames of the chunks after the first one have no targets
+        chunk_y = stream_y[index*step:index*step+tbptt_len]
+        if t_overlap > 0:
+            chunk_y = T.set_subtensor(chunk_y[:T.minimum(index, 1)*t_overlap], 0)
+
+        givens = {self.x: stream_x[index*step:index*step+tbptt_len],
+                  self.y: chunk_y,
+                  self.is_train: np.cast['int32'](1)}
+
+        updates = OrderedDict(updates)
+        self.tbptt_states = []
+        for layer in self.rnn_layers:
+            if isinstance(layer, BidirectionBase) or not hasattr(layer, 'h0'):
+                continue
+            if isinstance(layer, CuDNNRNNLayer) or hasattr(layer, 'y0') or not hasattr(layer, 'h'):
+                logger.critical("This hidden layer: %s cannot carry its states from one chunk to the next, it cannot be trained with truncated BPTT\n" %(type(layer).__name__))
+                sys.exit(1)
+            states = [(layer.h0, layer.h)]
+            if hasattr(layer, 'c'):
+                states.append((layer.c0, layer.c))
+            if any(init.ndim != 2 for init, _ in states):
+                logger.critical("This hidden layer: %s has no initial states for a batch of streams, it cannot be trained with truncated BPTT\n" %(type(layer).__name__))
+                sys.exit(1)
+            for init, state in states:
+                carried = shared_on_target(np.zeros((n_streams, layer.n_h), dtype=theano.config.floatX), 'tbptt_state', target_of(init))
+                givens[init] = carried
+                updates[carried] = state[T.minimum(step, state.shape[0]) - 1]
+                self.tbptt_states.append(carried)
+
+        train_model = self.compile_function(inputs = [index, lr, mom],
+                                      outputs = self.errors,
+                                      updates = updates,
+                                      givens = givens, on_unused_input='ignore')
+
+        return train_model
+
+    def get_tbptt_num_chunks(self, n_frames):
+        """ This function returns the number of truncated BPTT chunks of a training partition
+
+        :param n_frames: number of frames in the training partition
+        :returns: number of chunks, the indices of the training function range over [0, num_chunks)
+        """
+
+        stream_len = n_frames // self.n_streams
+        step = self.tbptt_len - self.t_overlap
+
+        return max(0, (stream_len - self.t_overlap + step - 1) // step)
+
+    def reset_tbptt_state(self):
+        """ This function resets the carried hidden states of truncated BPTT, to be called whenever a new partition of training data is loaded
+        """
+
+        for state in getattr(self, 'tbptt_states', []):
+            state.set_value(np.zeros_like(state.get_value(borrow=True)))
+
     def build_finetune_functions_S2S(self, train_shared_xyd, valid_shared_xyd):
         """ This function is to build finetune functions and to update gradients
         
@@ -322,16 +744,9 @@ class DeepEncoderDecoderNetwork(object):
         gparams = T.grad(cost, self.params)
 
 
-        # zip just concatenate two lists
-        updates = OrderedDict()
-
-        for param, gparam in zip(self.params, gparams):
-            weight_update = self.updates[param]
-            upd = mom * weight_update - lr * gparam
-            updates[weight_update] = upd
-            updates[param] = param + upd
+        updates = self.flat_sgd_updates(self.params, gparams, lr, mom)
 
-        train_model = theano.function(inputs = [lr, mom],  
+        train_model = self.compile_function(inputs = [lr, mom],  
                                       outputs = self.errors,
                                       updates = updates,
                                       givens = {self.x: train_set_x, 
@@ -340,7 +755,7 @@ class DeepEncoderDecoderNetwork(object):
                                                 self.is_train: np.cast['int32'](1)}, on_unused_input='ignore')
 
 
-        valid_model = theano.function(inputs = [],
+        valid_model = self.compile_function(inputs = [],
                                       outputs = self.errors,
                                       givens = {self.x: valid_set_x,
                                                 self.y: valid_set_y,
@@ -377,17 +792,9 @@ class DeepEncoderDecoderNetwork(object):
 
         # use optimizer
         if self.optimizer=='sgd':
-            # zip just concatenate two lists
-            updates = OrderedDict()
-
-            for i, (param, gparam) in enumerate(zip(params, gparams)):
-                weight_update = self.updates[param]
-                if i >= encoder_params:
-                    upd = mom * weight_update - lr * gparam
-                else:
-                    upd = mom * weight_update - (lr*2) * gparam
-                updates[weight_update] = upd
-                updates[param] = param + upd
+            # the encoder is trained with twice the learning rate
+            lr_scales = [2] * encoder_params + [1] * (len(params) - encoder_params)
+            updates = self.flat_sgd_updates(params, gparams, lr, mom, lr_scales=lr_scales)
 
         elif self.optimizer=='adam':
             updates = compile_ADAM_train_function(self, gparams, learning_rate=lr)
@@ -398,7 +805,7 @@ class DeepEncoderDecoderNetwork(object):
             sys.exit(1)
 
 
-        train_model = theano.function(inputs = [lr, mom],  
+        train_model = self.compile_function(inputs = [lr, mom],  
                                       outputs = self.errors,
                                       updates = updates,
                                       givens = {self.x: train_set_x, 
@@ -408,7 +815,7 @@ class DeepEncoderDecoderNetwork(object):
                                                 self.is_train: np.cast['int32'](1)}, on_unused_input='ignore')
 
 
-        valid_model = theano.function(inputs = [],
+        valid_model = self.compile_function(inputs = [],
                                       outputs = self.errors,
                                       givens = {self.x: valid_set_x,
                                                 self.y: valid_set_y,
@@ -418,6 +825,149 @@ class DeepEncoderDecoderNetwork(object):
  
         return  train_model, valid_model
 
+    def compile_function(self, inputs, outputs, **kwargs):
+        """ This function is to compile a theano function, with the same arguments as theano.function
+
+        When self.function_cache_dir is set, the shared variables of the graph are lifted to inputs, and the compiled
+        function is stored there under a hash of the graph, so that a later process building the same graph loads it
+        instead of compiling again. Only functions without updates, i.e. the prediction and validation functions, are cached.
+        The training functions are compiled as usual so that the parameters keep being updated in place: a compiled function
+        cannot be re-bound to the shared variables of another process, Function.copy(swap=...) fails on scan gradients.
+
+        """
+
+        cache_dir = getattr(self, 'function_cache_dir', None)
+        if cache_dir is None or kwargs.get('updates'):
+            return theano.function(inputs, outputs, **kwargs)
+
+        single_output = not isinstance(outputs, (list, tuple))
+        outputs = [outputs] if single_output else list(outputs)
+
+        # values in givens become shared variables of the function, as theano.function does with them
+        givens = OrderedDict((variable, value if isinstance(value, theano.gof.Variable) else theano.shared(value))
+                             for variable, value in (kwargs.pop('givens', None) or {}).items())
+
+        kwargs.pop('updates', None)
+        outputs, update_values, updated, shared_variables, stand_ins = lift_shared_variables(outputs, givens)
+
+        inputs = list(inputs) + stand_ins
+        outputs = outputs + update_values
+        cache_file = os.path.join(cache_dir, 'function_%s.pkl' %(graph_signature(inputs, outputs)))
+
+        # compiled graphs with scan loops are pickled with deep recursion
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 20000))
+
+        try:
+            function = self.load_or_compile_function(cache_file, inputs, outputs, **kwargs)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+        return CachedFunction(function, shared_variables, updated, len(outputs) - len(update_values), single_output)
+
+    def load_or_compile_function(self, cache_file, inputs, outputs, **kwargs):
+        """ This function is to load a compiled function from cache_file, or to compile it and store it there, see :func:`compile_function`
+        """
+
+        logger = logging.getLogger("merlin.DNN initialization")
+
+        if os.path.isfile(cache_file):
+            try:
+                with theano.change_flags(reoptimize_unpickled_function=False):
+                    with open(cache_file, 'rb') as fid:
+                        return pickle.load(fid)
+            except Exception as e:
+                logger.warning("Cannot load the compiled function in %s: %s" %(cache_file, e))
+
+        function = theano.function(inputs, outputs, **kwargs)
+
+        try:
+            cache_dir = os.path.dirname(cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache_file + '.tmp', 'wb') as fid:
+                pickle.dump(function, fid, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_file + '.tmp', cache_file)
+        except Exception as e:
+            logger.warning("Cannot store the compiled function in %s: %s" %(cache_file, e))
+
+        return function
+
+    def get_prediction_function(self, key, output, inputs):
+        """ This function is to compile a prediction function once and to reuse it for the following sentences
+
+        :param key: key of the compiled function in the cache
+        :param output: the symbolic output to predict
+        :param inputs: the symbolic inputs of the network, which become the arguments of the compiled function
+        :returns: the compiled theano function
+
+        """
+
+        # models pickled before the functions were cached
+        if not hasattr(self, 'prediction_functions'):
+            self.prediction_functions = {}
+
+        if key not in self.prediction_functions:
+            # float16 networks return the features in float32
+            if output.dtype == 'float16':
+                output = T.cast(output, 'float32')
+            givens = {self.is_train: np.cast['int32'](0)}
+            # a single utterance is predicted at a time
+            if getattr(self, 'packed_training', False):
+                givens[self.seg_ends] = T.cast(self.x.shape[:1], 'int32')
+            self.prediction_functions[key] = self.compile_function([theano.In(variable, borrow=True, allow_downcast=True) for variable in inputs], output,
+                                                             givens=givens, on_unused_input='ignore')
+
+        return self.prediction_functions[key]
+
+    def __getstate__(self):
+        """ The compiled prediction functions and the cached gradients are not pickled with the model, they are built again when needed
+        """
+
+        state = self.__dict__.copy()
+        state.pop('prediction_functions', None)
+        state.pop('fp16_network', None)
+        state.pop('fp16_cast', None)
+        state.pop('finetune_gradients', None)
+
+        return state
+
+    def inference_network(self):
+        """ This function returns the network to predict with, which is a float16 copy of this network when fp16_inference is set
+
+        The copy is built on first use for prediction only, on the default device and without the compiled function cache,
+        and the current values of the parameters are cast to it on every call by a compiled function, on the device, so that it
+        follows training and set_value.
+        """
+
+        logger = logging.getLogger("merlin.DNN initialization")
+
+        if not getattr(self, 'fp16_inference', False):
+            return self
+
+        if not hasattr(self, 'init_kwargs'):
+            logger.warning("This model was saved without its architecture arguments, predicting in %s" %(theano.config.floatX))
+            self.fp16_inference = False
+            return self
+
+        if not hasattr(self, 'fp16_network'):
+            if not theano.config.device.startswith(('cuda', 'gpu')):
+                logger.warning("Predicting in float16 on device %s, which has no float16 arithmetic and is usually slower than %s" %(theano.config.device, theano.config.floatX))
+
+            # the packed utterances are predicted one at a time, which is the same graph as without packing
+            kwargs = dict(self.init_kwargs, fp16_inference=False, inference_only=True, function_cache_dir=None,
+                          device_map=None, bidirectional_contexts=None, packed_training=False,
+                          cudnn_rnn=getattr(self, 'cudnn_rnn', False) and not getattr(self, 'packed_training', False))
+            with theano.change_flags(floatX='float16'):
+                self.fp16_network = DeepEncoderDecoderNetwork(**kwargs)
+
+            self.fp16_cast = theano.function([], updates=[(fp16_param, T.cast(param, 'float16'))
+                                                          for param, fp16_param in zip(self.params, self.fp16_network.params)])
+
+        self.fp16_cast()
+
+        return self.fp16_network
+
     def parameter_prediction(self, test_set_x):  #, batch_size
         """ This function is to predict the output of NN
         
@@ -428,12 +978,11 @@ class DeepEncoderDecoderNetwork(object):
         """
     
 
-        n_test_set_x = test_set_x.shape[0]
+        net = self.inference_network()
 
-        test_out = theano.function([], self.final_layer.output,
-              givens={self.x: test_set_x[0:n_test_set_x], self.is_train: np.cast['int32'](0)}, on_unused_input='ignore')
+        test_out = net.get_prediction_function('frame', net.final_layer.output, [net.x])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x)
 
         return predict_parameter    
 
@@ -450,10 +999,11 @@ class DeepEncoderDecoderNetwork(object):
 
         n_test_set_x = test_set_x.shape[0]
 
-        test_out = theano.function([], self.final_layer.output,
-                givens={self.x: test_set_x[0:n_test_set_x], self.d: test_set_d[0:n_test_set_x], self.is_train: np.cast['int32'](0)}, on_unused_input='ignore')
+        net = self.inference_network()
+
+        test_out = net.get_prediction_function('S2S', net.final_layer.output, [net.x, net.d])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x, test_set_d[0:n_test_set_x])
 
         return predict_parameter
 
@@ -468,57 +1018,51 @@ class DeepEncoderDecoderNetwork(object):
         
         """
 
-        n_test_set_x  = test_set_x.shape[0]
-        num_of_frames = sum(test_set_d)
+        net = self.inference_network()
 
-        test_out = theano.function([], self.final_layer.output,
-                givens={self.x: test_set_x[0:n_test_set_x], self.d: test_set_d, self.f: test_set_f, self.is_train: np.cast['int32'](0)}, on_unused_input='ignore')
+        test_out = net.get_prediction_function('S2SPF', net.final_layer.output, [net.x, net.d, net.f])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x, test_set_d, test_set_f)
 
         return predict_parameter
 
     def parameter_prediction_CTC(self, test_set_x):  #, batch_size
 
-        n_test_set_x = test_set_x.shape[0]
+        net = self.inference_network()
 
-        test_out = theano.function([], self.rnn_layers[-1].output,
-              givens={self.x: test_set_x[0:n_test_set_x]})
+        test_out = net.get_prediction_function('CTC', net.rnn_layers[-1].output, [net.x])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x)
 
         return predict_parameter
 
     def parameter_prediction_MDN(self, test_set_x):  #, batch_size
 
-        n_test_set_x = test_set_x.get_value(borrow=True).shape[0]
+        net = self.inference_network()
 
-        test_out = theano.function([], self.final_layer.mu,
-              givens={self.x: test_set_x[0:n_test_set_x]})
+        test_out = net.get_prediction_function('mu', net.final_layer.mu, [net.x])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x.get_value(borrow=True))
 
         return predict_parameter
 
     def parameter_prediction_mix(self, test_set_x):  #, batch_size
 
-        n_test_set_x = test_set_x.get_value(borrow=True).shape[0]
+        net = self.inference_network()
 
-        test_out = theano.function([], self.final_layer.mix,
-              givens={self.x: test_set_x[0:n_test_set_x]})
+        test_out = net.get_prediction_function('mix', net.final_layer.mix, [net.x])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x.get_value(borrow=True))
 
         return predict_parameter
 
     def parameter_prediction_sigma(self, test_set_x):  #, batch_size
 
-        n_test_set_x = test_set_x.get_value(borrow=True).shape[0]
+        net = self.inference_network()
 
-        test_out = theano.function([], self.final_layer.sigma,
-              givens={self.x: test_set_x[0:n_test_set_x]})
+        test_out = net.get_prediction_function('sigma', net.final_layer.sigma, [net.x])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x.get_value(borrow=True))
 
         return predict_parameter
     
@@ -532,12 +1076,172 @@ class DeepEncoderDecoderNetwork(object):
 
         """
 
-        n_test_set_x = test_set_x.shape[0]
+        net = self.inference_network()
 
-        test_out = theano.function([], self.rnn_layers[bn_layer_index].output,
-                givens={self.x: test_set_x, self.is_train: np.cast['int32'](0)}, on_unused_input='ignore')
+        test_out = net.get_prediction_function(('hidden', bn_layer_index), net.rnn_layers[bn_layer_index].output, [net.x])
 
-        predict_parameter = test_out()
+        predict_parameter = test_out(test_set_x)
 
         return predict_parameter
 
+
+class BatchedPredictor(object):
+    """
+    This class is to predict the output features of several sentences with one forward pass. Sentences submitted by concurrent
+    callers are queued, and a background thread coalesces up to max_batch_size of them, or those arriving within max_wait seconds,
+    into a zero-padded (T_max, batch, n_in) input of a network built with rnn_batch_training=True.
+
+    The frames of a sentence only depend on the preceding frames in unidirectional networks, so the padding does not change their
+    predictions. The backward direction of a bidirectional layer would start on the padding of the shorter sentences, so networks
+    with bidirectional layers only batch the sentences of the same length together.
+    Sequence-to-sequence networks index the frames by phone durations of a single sentence and cannot be batched this way.
+
+    """
+
+    def __init__(self, dnn_model, max_batch_size=32, max_wait=0.005):
+        """ This function starts the prediction thread
+
+        :param dnn_model: a :class:`DeepEncoderDecoderNetwork` built with rnn_batch_training=True
+        :param max_batch_size: the maximum number of sentences in a forward pass
+        :param max_wait: the time in seconds to wait for more sentences after the first one of a batch arrived
+        """
+
+        logger = logging.getLogger("merlin.BatchedPredictor")
+
+        if not dnn_model.rnn_batch_training:
+            logger.critical("Batched prediction needs a network built with rnn_batch_training=True\n")
+            sys.exit(1)
+
+        self.dnn_model = dnn_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # the backward direction starts at the last frame of the padded batch
+        self.equal_lengths = any(isinstance(layer, BidirectionBase) or getattr(layer, 'direction_mode', None) == 'bidirectional'
+                                 for layer in dnn_model.rnn_layers)
+
+        self.requests = queue.Queue()
+
+        # the exception which stopped the prediction thread, the sentences submitted after it fail at once
+        self.error = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def predict(self, test_set_x):
+        """ This function queues a sentence for prediction
+
+        :param test_set_x: input features for a testing sentence, (n_frames, n_in)
+        :returns: a Future whose result is the predicted features, (n_frames, n_out)
+        """
+
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Cannot predict with a BatchedPredictor after close()")
+            if self.error is not None:
+                future.set_exception(self.error)
+            else:
+                self.requests.put((test_set_x, future))
+
+        return future
+
+    def parameter_prediction(self, test_set_x):
+        """ This function predicts the output of a sentence, blocking until its batch has been computed
+        """
+
+        return self.predict(test_set_x).result()
+
+    def close(self):
+        """ This function predicts the queued sentences and stops the prediction thread
+        """
+
+        with self.lock:
+            self.closed = True
+            self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+
+        try:
+            self.serve()
+        except BaseException as e:
+            # e.g. the SystemExit of a critical error in the model, the thread stops and fails the queued sentences
+            self.fail_queued(e)
+
+    def fail_queued(self, e):
+
+        with self.lock:
+            self.error = e
+
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None:
+                request[1].set_exception(e)
+
+    def serve(self):
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            batch = [request]
+            deadline = time.time() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.predict_batch(batch)
+                    return
+                batch.append(request)
+
+            self.predict_batch(batch)
+
+    def predict_batch(self, batch):
+
+        if self.equal_lengths:
+            groups = OrderedDict()
+            for request in batch:
+                groups.setdefault(request[0].shape[0], []).append(request)
+            groups = list(groups.values())
+        else:
+            groups = [batch]
+
+        try:
+            predictions = [self.predict_padded(group) for group in groups]
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            # the thread goes on with the next batch after an error of this one, but stops on SystemExit and KeyboardInterrupt
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        for group, group_y in zip(groups, predictions):
+            for (_, future), test_set_y in zip(group, group_y):
+                future.set_result(test_set_y)
+
+    def predict_padded(self, batch):
+
+        lengths = [test_set_x.shape[0] for test_set_x, _ in batch]
+
+        batch_x = np.zeros((max(lengths), len(batch), batch[0][0].shape[1]), dtype=theano.config.floatX)
+        for i, (test_set_x, _) in enumerate(batch):
+            batch_x[:lengths[i], i] = test_set_x
+
+        batch_y = self.dnn_model.parameter_prediction(batch_x)
+
+        return [batch_y[:lengths[i], i] for i in range(len(batch))]
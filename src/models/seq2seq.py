@@ -42,8 +42,9 @@ class DistributedSequenceEncoder(object):
         self.encoded_output = self.encode_all_states()
 
     ### Distributed seq-to-seq model: tile C_1-C_n as input to corresponding decoder frames ###
+    ### a single gather with the frame-to-segment index, no loop over the segments ###
     def encode_all_states(self):
-        reps = T.repeat(T.arange(self.dur_input.size), self.dur_input)
+        reps = T.repeat(T.arange(self.dur_input.shape[0]), self.dur_input)
         dist_context_vector = self.input[reps]
 
         return dist_context_vector
@@ -28,9 +28,19 @@ import theano.tensor as T
 import numpy as np
 from collections import OrderedDict
 
-def compile_ADAM_train_function(model, gparams, learning_rate=0.0002, b1=0.1, b2=0.001, e=1e-8):
+from layers.layers import shared_on_target, group_by_target
+
+def compile_ADAM_train_function(model, gparams, learning_rate=0.0002, b1=0.1, b2=0.001, e=1e-8, params=None):
+    """ Adam updates of the parameters, with the first and second moments of the parameters in two flat vectors,
+    so that each step updates the moments with one elemwise operation whatever the number of layers. The parameters
+    of a network partitioned across several GPUs get a pair of flat vectors on each of their devices.
+
+    :param params: the parameters to update, model.params by default
+    """
     updates = OrderedDict()
-    params = model.params
+    if params is None:
+        params = model.params
+    params = params[:len(gparams)]
     grads = gparams
     lr = learning_rate
     i = theano.shared(np.float32(0.))
@@ -38,19 +48,29 @@ def compile_ADAM_train_function(model, gparams, learning_rate=0.0002, b1=0.1, b2
     fix1 = 1. - (1. - b1)**i_t
     fix2 = 1. - (1. - b2)**i_t
     lr_t = lr * (T.sqrt(fix2) / fix1)
-    for p, g in zip(params, grads):
-        m = theano.shared(np.zeros(p.get_value().shape).astype(dtype=theano.config.floatX))
-        v = theano.shared(np.zeros(p.get_value().shape).astype(dtype=theano.config.floatX))
+
+    # the shapes are read without copying the parameters from the device
+    shapes = [p.get_value(borrow=True, return_internal_type=True).shape for p in params]
+    sizes = [int(np.prod(shape)) for shape in shapes]
+
+    for target, indices in group_by_target(params).items():
+        n_values = sum(sizes[k] for k in indices)
+        m = shared_on_target(np.zeros((n_values, ), dtype=theano.config.floatX), 'adam_m', target)
+        v = shared_on_target(np.zeros((n_values, ), dtype=theano.config.floatX), 'adam_v', target)
+        g = T.concatenate([T.flatten(grads[k]) for k in indices])
+
         m_t = (b1 * g) + ((1. - b1) * m)
         v_t = (b2 * T.sqr(g)) + ((1. - b2) * v)
         g_t = m_t / (T.sqrt(v_t) + e)
-        p_t = p - (lr_t * g_t)
-        #updates.append((m, m_t))
-        #updates.append((v, v_t))
-        #updates.append((p, p_t))
         updates[m] = m_t
         updates[v] = v_t
-        updates[p] = p_t
+
+        offset = 0
+        for k in indices:
+            p = params[k]
+            p_t = p - (lr_t * T.reshape(g_t[offset:offset+sizes[k]], shapes[k]))
+            updates[p] = p_t
+            offset += sizes[k]
     
     updates[i] = i_t
 
@@ -37,6 +37,7 @@
 #  THIS SOFTWARE.
 ################################################################################
 
+import sys
 import numpy
 import theano
 import theano.tensor as T
@@ -47,9 +48,11 @@ matplotlib.use('Agg')
 import  matplotlib.pyplot as plt
 from collections import OrderedDict
 
-def compile_RPROP_train_function(model, gparams, learning_rate=0.001, rprop_algo=2, params_to_update=[]):
+from layers.layers import shared_on_target, group_by_target
 
-    if params_to_update == []:  ## then update all by default
+def compile_RPROP_train_function(model, gparams, learning_rate=0.001, rprop_algo=2, params_to_update=None):
+
+    if params_to_update is None:  ## then update all by default, an empty list updates nothing
         params_to_update = list(range(len(gparams)))
 
     ## 1, 2, 3, 4: Rprop+ Rprop- iRprop+ iRprop-
@@ -69,51 +72,65 @@ def compile_RPROP_train_function(model, gparams, learning_rate=0.001, rprop_algo
     model.use_rprop = rprop_algo
     model.rprop_init_update = learning_rate
 
-    model.previous_gparams = []
-    model.update_values = []
+    ## the previous gradients, the update steps and the debug values of the updated parameters are kept in flat
+    ## vectors, one for each device the parameters are placed on, so that each iteration computes the update steps
+    ## with one elemwise operation per device
+    model.rprop_params = [model.params[i] for i in params_to_update]
+    rprop_gparams = [gparams[i] for i in params_to_update]
+    model.rprop_shapes = [weights.get_value(borrow=True, return_internal_type=True).shape for weights in model.rprop_params]
+    model.rprop_sizes  = [int(numpy.prod(shape)) for shape in model.rprop_shapes]
+    model.rprop_groups = group_by_target(model.rprop_params)
+
+    model.previous_gparams = OrderedDict()
+    model.update_values = OrderedDict()
+    model.update_change_DEBUG = OrderedDict()
 
-    model.update_change_DEBUG = []
+    for target, indices in model.rprop_groups.items():
+        n_values = sum(model.rprop_sizes[k] for k in indices)
 
-    for (i, weights) in enumerate(model.params):
-        model.previous_gparams.append(theano.shared(value = numpy.zeros((numpy.shape(weights.get_value())),
-                        dtype=theano.config.floatX), name='pg_%s'%(i)))
-        model.update_values.append(theano.shared(value =
-                (numpy.ones(numpy.shape(weights.get_value()), \
-                        dtype=theano.config.floatX) * model.rprop_init_update ), name='uv_%s'%(i)))
+        model.previous_gparams[target] = shared_on_target(numpy.zeros((n_values, ), dtype=theano.config.floatX), 'pg', target)
+        model.update_values[target] = shared_on_target(numpy.ones((n_values, ), dtype=theano.config.floatX) * model.rprop_init_update, 'uv', target)
 
-        model.update_change_DEBUG.append(theano.shared(value = numpy.zeros((numpy.shape(weights.get_value())),
-                        dtype=theano.config.floatX), name='pcd_%s'%(i)))
+        model.update_change_DEBUG[target] = shared_on_target(numpy.zeros((n_values, ), dtype=theano.config.floatX), 'pcd', target)
 
 
     if model.use_rprop in [2,4]:
 
         updates = OrderedDict()
 
-        for (i, (prev_gparam, gparam, update_step, param))  in enumerate(zip(model.previous_gparams, gparams, \
-                                                        model.update_values, model.params)):
-            if i in params_to_update:
-                ## first update update_values:
-                sign_change_test = prev_gparam * gparam
-                increase_update_size = T.gt(sign_change_test, 0.0) * model.eta_plus
-                decrease_update_size = T.lt(sign_change_test, 0.0) * model.eta_minus
-                retain_update_size   = T.eq(sign_change_test, 0.0)
-                update_changes = increase_update_size + decrease_update_size + retain_update_size
-                new_update_step = update_step * update_changes
-                ## apply floor/ceiling to updates:
-                new_update_step = T.minimum(model.max_update, T.maximum(model.min_update, new_update_step))
-                updates[update_step] = new_update_step
+        for target, indices in model.rprop_groups.items():
+
+            prev_gparam = model.previous_gparams[target]
+            update_step = model.update_values[target]
+            gparam = T.concatenate([T.flatten(rprop_gparams[k]) for k in indices])
 
-                if model.use_rprop == 4:
-                    ## zero gradients where sign changed: reduce step size but don't change weight
-                    gparam = gparam * (T.gt(sign_change_test, 0.0) + T.eq(sign_change_test, 0.0))
+            ## first update update_values:
+            sign_change_test = prev_gparam * gparam
+            increase_update_size = T.gt(sign_change_test, 0.0) * model.eta_plus
+            decrease_update_size = T.lt(sign_change_test, 0.0) * model.eta_minus
+            retain_update_size   = T.eq(sign_change_test, 0.0)
+            update_changes = increase_update_size + decrease_update_size + retain_update_size
+            new_update_step = update_step * update_changes
+            ## apply floor/ceiling to updates:
+            new_update_step = T.minimum(model.max_update, T.maximum(model.min_update, new_update_step))
+            updates[update_step] = new_update_step
 
-                ## then update params:
-                updates[param] = param - T.sgn(gparam) * new_update_step
+            if model.use_rprop == 4:
+                ## zero gradients where sign changed: reduce step size but don't change weight
+                gparam = gparam * (T.gt(sign_change_test, 0.0) + T.eq(sign_change_test, 0.0))
 
-                ## store previous iteration gradient to check for sign change in next iteration:
-                updates[prev_gparam] = gparam
+            ## then update params:
+            step = T.sgn(gparam) * new_update_step
+            offset = 0
+            for k in indices:
+                param = model.rprop_params[k]
+                updates[param] = param - T.reshape(step[offset:offset+model.rprop_sizes[k]], model.rprop_shapes[k])
+                offset += model.rprop_sizes[k]
 
-                updates[model.update_change_DEBUG[i]] = param  # gparam # sign_change_test #  update_changes    #
+            ## store previous iteration gradient to check for sign change in next iteration:
+            updates[prev_gparam] = gparam
+
+            updates[model.update_change_DEBUG[target]] = T.concatenate([T.flatten(model.rprop_params[k]) for k in indices])  # gparam # sign_change_test #  update_changes    #
 
     else:
         sys.exit('RPROP version %s not implemented'%(model.use_rprop))
@@ -123,24 +140,30 @@ def compile_RPROP_train_function(model, gparams, learning_rate=0.001, rprop_algo
 
 def check_rprop_values(model):
     print('=== Update steps: ===')
-    for (i, update_step) in enumerate(model.update_values):
-        print('   param no. %s'%(i))
-        print(get_stats(update_step))
-        v = update_step.get_value()
-        if len(v.shape) == 2:
-            print(v[:4, :4])
-        else:
-            print(v[:4])
-        print('   Update changes:--')
-        u = model.update_change_DEBUG[i].get_value()
-        if len(u.shape) == 2:
-            print(u[:4, :4])
-        else:
-            print(u[:4])
+    for target, indices in model.rprop_groups.items():
+        update_values = model.update_values[target].get_value()
+        update_changes = model.update_change_DEBUG[target].get_value()
+        offset = 0
+        for i in indices:
+            shape, size = model.rprop_shapes[i], model.rprop_sizes[i]
+            print('   param no. %s'%(i))
+            v = update_values[offset:offset+size].reshape(shape)
+            print(get_stats(v))
+            if len(v.shape) == 2:
+                print(v[:4, :4])
+            else:
+                print(v[:4])
+            print('   Update changes:--')
+            u = update_changes[offset:offset+size].reshape(shape)
+            if len(u.shape) == 2:
+                print(u[:4, :4])
+            else:
+                print(u[:4])
+            offset += size
 
 
 def get_stats(theano_shared_params):
-    vals = theano_shared_params.get_value()
+    vals = theano_shared_params.get_value() if hasattr(theano_shared_params, 'get_value') else theano_shared_params
     #m,n = numpy.shape(vals)
     print('   shape, minm max, mean, 5th and 95th percentile')
     print('   %s %s %s %s %s %s'%(numpy.shape(vals),vals.min(), vals.max(),vals.mean(), numpy.percentile(vals, 5), numpy.percentile(vals, 95)))